@@ -18,7 +18,7 @@ Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
 
 
 MODULE NAME: alimport.py
-DESCRIPTION: MSA importation from various format through BioPython
+DESCRIPTION: MSA importation from various format (fasta and relaxed phylip natively, the others through BioPython)
 INPUTS:      Input MSAs
 CALLED BY:   caas_id.py, fastcaas_core.py, disco.py
 
@@ -29,15 +29,51 @@ import_position()           Imports a position from a BioPython imported alignme
 filter_position()           This function is designed to exclude those positions that are so conserved
                             that it is impossible (or unlikely) for them to return a CAAS.
 
+build_matrix()              Builds the (species x columns) uint8 alignment matrix.
+
+alignment_matrix()          Converts a BioPython imported alignment into a
+                            (species x columns) uint8 matrix.
+
+read_fasta()                Native fasta reader.
+
+read_phylip_relaxed()       Native relaxed phylip reader.
+
+read_alignment()            Reads an alignment into a matrix (native readers
+                            or BioPython for the other formats).
+
+filter_columns()            Vectorized version of filter_position(). Evaluates
+                            the columns of an alignment matrix in chunks.
+
+matrix_position()           Builds the position dictionary of one column
+                            of the alignment matrix (same output of import_position()).
+
+slice_object                The sliced alignment (kept columns of the alignment
+                            matrix, position dictionaries built on request,
+                            chunks of columns).
+
+alignment_genename()        The gene name of an alignment file.
+
+select_columns()            Keeps the columns of a sliced alignment at some positions.
+
 slice()                     Filters the alignment and returns the
 
 '''                                                       
 
 
-from Bio import AlignIO
+from modules import profiler
+
+import numpy as np
 import functools
 
 
+GAP = ord("-")
+
+# Number of columns processed at once by the chunked steps (filters, CAAS scan, bootstrap): their
+# temporary arrays and output lines are bounded by the chunk, not by the length of the alignment.
+
+COLUMN_CHUNK = 2000
+
+
 # FUNCTION import_position()
 # Imports a position from a BioPython imported alignment
 
@@ -97,32 +133,260 @@ def filter_position(imported_position, changes_threshold, max_gaps_ratio):
     return outflag
 
 
+# FUNCTION build_matrix()
+# Builds the (species x columns) uint8 matrix from the sequence ids and the sequences (as bytes).
+# If a species appears more than once, the last sequence is kept (as in import_position()).
+
+def build_matrix(ids, sequences):
+
+    if len(sequences) == 0:
+        raise ValueError("No records found in the alignment")
+
+    length = len(sequences[0])
+
+    for x in sequences:
+        if len(x) != length:
+            raise ValueError("Sequences must all be the same length")
+
+    species_index = {}
+
+    for i, x in enumerate(ids):
+        species_index[x] = i
+
+    species = list(species_index.keys())
+    rows = list(species_index.values())
+
+    matrix = np.frombuffer(b"".join(sequences), dtype = np.uint8).reshape(len(sequences), length)
+    matrix = np.asfortranarray(matrix[rows])
+
+    return species, matrix
+
+
+# FUNCTION alignment_matrix()
+# Converts a BioPython imported alignment into a (species x columns) uint8 matrix.
+
+def alignment_matrix(imported_alignment):
+
+    ids = [record.id for record in imported_alignment]
+    sequences = [str(record.seq).encode("latin-1") for record in imported_alignment]
+
+    return build_matrix(ids, sequences)
+
+
+# FUNCTION read_fasta()
+# Native reader for fasta alignments. Reads the file in one go and returns the species and the alignment matrix.
+
+def read_fasta(alignment_file):
+
+    with open(alignment_file, "rb") as alignment_handle:
+        lines = alignment_handle.read().splitlines()
+
+    ids = []
+    sequences = []
+    current = None
+
+    for line in lines:
+        if line.startswith(b">"):
+            title = line[1:].split(None, 1)
+            ids.append(title[0].decode("latin-1") if len(title) > 0 else "")
+            current = []
+            sequences.append(current)
+
+        elif current != None:
+            current.append(line.replace(b" ", b"").replace(b"\t", b""))
+
+    sequences = [b"".join(x) for x in sequences]
+
+    return build_matrix(ids, sequences)
+
+
+# FUNCTION read_phylip_relaxed()
+# Native reader for relaxed phylip alignments (sequential or interleaved). Reads the file in one go
+# and returns the species and the alignment matrix.
+
+def read_phylip_relaxed(alignment_file):
+
+    with open(alignment_file, "rb") as alignment_handle:
+        lines = [x.strip() for x in alignment_handle.read().splitlines()]
+
+    lines = [x for x in lines if x != b""]
+
+    try:
+        header = lines[0].split()
+        number_of_seqs = int(header[0])
+        int(header[1])
+    except (IndexError, ValueError):
+        raise ValueError("First line should have two integers")
+
+    ids = []
+    sequences = []
+
+    # First block: species name and sequence
+
+    for line in lines[1:number_of_seqs + 1]:
+        c = line.split(None, 1)
+        ids.append(c[0].decode("latin-1"))
+        sequences.append([c[1].replace(b" ", b"") if len(c) > 1 else b""])
+
+    # Further blocks (interleaved format): sequence only
+
+    for i, line in enumerate(lines[number_of_seqs + 1:]):
+        sequences[i % number_of_seqs].append(line.replace(b" ", b""))
+
+    sequences = [b"".join(x) for x in sequences]
+
+    return build_matrix(ids, sequences)
+
+
+# FUNCTION read_alignment()
+# Reads an alignment and returns the species and the alignment matrix. Fasta and relaxed phylip are
+# read natively, the other formats through BioPython (imported only when needed).
+
+def read_alignment(alignment_file, alignment_format):
+
+    if alignment_format == "fasta":
+        return read_fasta(alignment_file)
+
+    if alignment_format == "phylip-relaxed":
+        return read_phylip_relaxed(alignment_file)
+
+    from Bio import AlignIO
+
+    return alignment_matrix(AlignIO.read(alignment_file, alignment_format))
+
+
+# FUNCTION filter_columns()
+# Vectorized version of filter_position(). Returns a boolean mask with the columns
+# that pass the gap ratio filter and the amino acid diversity (minimum changes) filter.
+
+def filter_columns(matrix, changes_threshold, max_gaps_ratio, chunk_size = COLUMN_CHUNK):
+
+    nspecies = matrix.shape[0]
+    kept = np.zeros(matrix.shape[1], dtype = bool)
+
+    for start in range(0, matrix.shape[1], chunk_size):
+        chunk = matrix[:, start:start + chunk_size]
+
+        # Filter per gaps
+        gaps = np.count_nonzero(chunk == GAP, axis = 0)
+        gaps_ratio = gaps / float(nspecies)
+
+        # Filter per amino acid diversity: the changes are the ungapped symbols minus the most frequent one
+        most_frequent = np.zeros(chunk.shape[1], dtype = np.int64)
+
+        for symbol in np.flatnonzero(np.bincount(chunk.ravel(order = "F"), minlength = 256)):
+            if symbol != GAP:
+                np.maximum(most_frequent, np.count_nonzero(chunk == symbol, axis = 0), out = most_frequent)
+
+        seconds = nspecies - gaps - most_frequent
+
+        kept[start:start + chunk.shape[1]] = (gaps_ratio <= max_gaps_ratio) & (seconds >= changes_threshold)
+
+        if profiler.enabled:
+            profiler.count("columns_discarded_gaps", np.count_nonzero(gaps_ratio > max_gaps_ratio))
+            profiler.count("columns_discarded_diversity", np.count_nonzero((gaps_ratio <= max_gaps_ratio) & (seconds < changes_threshold)))
+
+    return kept
+
+
+# FUNCTION matrix_position()
+# Builds the position dictionary of one column of the alignment matrix (same output of import_position())
+
+def matrix_position(column, position, species):
+
+    tag = "@" + str(position)
+    symbols = column.tobytes().decode("latin-1")
+
+    return dict(zip(species, [x + tag for x in symbols]))
+
+
+# CLASS slice_object
+# The sliced alignment: the kept columns of the alignment matrix. The position dictionaries (d) are only
+# built when requested (they are needed by the classic engines, not by the vector ones).
+
+class slice_object():
+
+    def __init__(self, genename = "", species = [], matrix = None, positions = None):
+        self.genename = genename
+        self.species = list(species)
+
+        self.matrix = matrix                # (species x kept columns) uint8 matrix, column-major
+        self.positions = positions          # Alignment position of each kept column
+        self.species_index = dict(zip(self.species, range(len(self.species))))      # Species to matrix row
+        self.trait_columns = None           # Per trait, the kept columns that can be a CAAS (see runslice.trait_prefilter())
+
+        self._d = None
+
+    @property
+    def d(self):
+        if self._d == None:
+            self._d = list(self.iter_positions())
+        return self._d
+
+    # The position dictionaries, one at a time (nothing is kept in memory)
+
+    def iter_positions(self):
+        for i, p in enumerate(self.positions):
+            yield matrix_position(self.matrix[:, i], p, self.species)
+
+    # The sliced alignment in chunks of columns. Yields the first column of each chunk and the chunk
+    # (a sliced object over a view of the matrix, with its slice of trait_columns)
+
+    def chunks(self, chunk_size = COLUMN_CHUNK):
+        for start in range(0, len(self.positions), chunk_size):
+            end = min(start + chunk_size, len(self.positions))
+
+            chunk = slice_object(self.genename, self.species, self.matrix[:, start:end], self.positions[start:end])
+
+            if self.trait_columns != None:
+                chunk.trait_columns = {x : y[start:end] for x, y in self.trait_columns.items()}
+
+            yield start, chunk
+
+
+# FUNCTION alignment_genename()
+# The gene name of an alignment file (the file name up to the first dot)
+
+def alignment_genename(alignment_file):
+    return alignment_file.split("/")[-1].split(".")[0]
+
+
+# FUNCTION select_columns()
+# Keeps the columns of a sliced alignment at the given alignment positions (if they survived the slicing)
+
+def select_columns(sliced_object, positions):
+
+    kept = np.isin(sliced_object.positions, list(positions))
+
+    return slice_object(sliced_object.genename, sliced_object.species, np.asfortranarray(sliced_object.matrix[:, kept]), sliced_object.positions[kept])
+
+
 # FUNCTION slice()
-# Generates a key file per each gene
+# Generates a key file per each gene. With positions, only those alignment positions are filtered (and kept, if they pass).
  
-def slice(alignment_file, alignment_format, column_threshold, max_gaps = 0.5):
+def slice(alignment_file, alignment_format, column_threshold, max_gaps = 0.5, positions = None, chunk_size = COLUMN_CHUNK):
 
-    class slice_object():
-        def __init__(self):
-            self.d = []
-            self.genename = ""
-            self.species = []
-    
-    z = slice_object()
-    imported_alignment = AlignIO.read(alignment_file, alignment_format)
-    z.genename = alignment_file.split("/")[-1].split(".")[0]
+    genename = alignment_genename(alignment_file)
 
-    # SPECIES IN THE ALIGNMENT
+    # SPECIES IN THE ALIGNMENT AND ALIGNMENT MATRIX
 
-    for x in imported_alignment:
-        z.species.append(x.id)
-    
-    z.species = list(set(z.species))
+    with profiler.stage("read_alignment"):
+        species, matrix = read_alignment(alignment_file, alignment_format)
+
+    # SELECTING THE REQUESTED POSITIONS (if any)
+
+    columns = np.arange(matrix.shape[1])
+
+    if positions != None:
+        columns = np.array(sorted([x for x in set(positions) if 0 <= x < matrix.shape[1]]), dtype = np.int64)
+        matrix = matrix[:, columns]
+
+    # FILTERING POSITIONS (all the columns at once)
 
-    # IMPORTING POSITIONS
+    with profiler.stage("filter_columns"):
+        kept = filter_columns(matrix, column_threshold, max_gaps, chunk_size)
 
-    imported_positions = list(map(functools.partial(import_position, imported_alignment = imported_alignment), [position for position in range(0,imported_alignment.get_alignment_length())]))
+    profiler.count("columns", matrix.shape[1])
+    profiler.count("columns_kept", np.count_nonzero(kept))
 
-    # FILTERING POSITIONS
-    z.d = list(filter(functools.partial(filter_position, changes_threshold = column_threshold, max_gaps_ratio = max_gaps), imported_positions))
-    return z
\ No newline at end of file
+    return slice_object(genename, species, np.asfortranarray(matrix[:, kept]), columns[kept])
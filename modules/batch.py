@@ -0,0 +1,334 @@
+#                      _              _     
+#                     | |            | |    
+#   ___ __ _  __ _ ___| |_ ___   ___ | |___ 
+#  / __/ _` |/ _` / __| __/ _ \ / _ \| / __|
+# | (_| (_| | (_| \__ \ || (_) | (_) | \__ \
+#  \___\__,_|\__,_|___/\__\___/ \___/|_|___/
+
+
+'''
+A Convergent Amino Acid Substitution identification 
+and analysis toolbox
+
+Author:         Fabio Barteri (fabio.barteri@upf.edu)
+
+Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
+                Xavier Farré (xfarrer@igtp.cat),
+                David de Juan (david.juan@upf.edu).
+
+MODULE NAME:    batch.py
+DESCRIPTION:    Runs the discovery or the bootstrap on many alignments within one single process pool.
+DEPENDENCIES:   disco.py, boot.py, init_bootstrap.py, runslice.py, pindex.py, profiler.py
+CALLED BY:      ct
+
+TABLE OF CONTENTS
+------------------------------------------
+collect_alignments()        Lists the alignments from a directory, a glob
+                            pattern or a list file (one path per line).
+
+discovery_on_alignment()    Slices one alignment and runs the discovery on it
+                            (the worker function, profiled with --profile).
+
+batch_discovery()           Distributes the alignments across the workers and
+                            writes all the CAAS into one table.
+
+bootstrap_on_alignment()    Slices one alignment and runs the bootstrap on it
+                            (the worker function, profiled with --profile).
+
+batch_bootstrap()           Loads the resampled traits once, distributes the
+                            alignments across the workers and writes one
+                            bootstrap table.
+'''
+
+from modules.disco import *
+from modules.runslice import runslice, column_threshold, column_chunk
+from modules.pindex import load_traits, compile_traits
+from modules.boot import boot_on_single_alignment, load_targets
+from modules.init_bootstrap import simtrait_revive
+from modules.alimport import alignment_genename
+from modules import profiler
+
+import os
+import sys
+import copy
+import glob
+import multiprocessing
+
+
+# FUNCTION collect_alignments()
+# Lists the alignments from a directory, a glob pattern or a list file (one path per line)
+
+def collect_alignments(alignments_input):
+
+    if os.path.isdir(alignments_input):
+        alignments = glob.glob(alignments_input.rstrip("/") + "/*")
+        alignments = [x for x in alignments if os.path.isfile(x)]
+        alignments.sort()
+
+    elif os.path.isfile(alignments_input):
+        with open(alignments_input) as list_handle:
+            alignments = [x.strip() for x in list_handle.read().splitlines() if x.strip() != ""]
+
+    else:
+        alignments = glob.glob(alignments_input)
+        alignments.sort()
+
+    return alignments
+
+
+# The batch settings. They are set once per worker by init_worker(), so that
+# the trait object is not shipped again with every single alignment.
+
+batch_settings = {}
+
+def init_worker(options_object, trait_object, c_threshold):
+
+    # The table goes to the standard output: the messages of the workers go to the standard error
+    if options_object.output_file == "-":
+        sys.stdout = sys.stderr
+
+    batch_settings["options"] = options_object
+    batch_settings["trait_object"] = trait_object
+    batch_settings["c_threshold"] = c_threshold
+
+    if getattr(options_object, "profile", "none") != "none" and not profiler.enabled:
+        profiler.enable_profile()
+
+
+# FUNCTION discovery_on_alignment()
+# Slices one alignment and runs the discovery on it. Returns the output lines of the gene and its profile report (None
+# without --profile).
+
+def discovery_on_alignment(alignment_file):
+
+    if profiler.enabled:
+        saved_profile = profiler.start_run()
+        gene_lines = discovery_lines(alignment_file)
+        return gene_lines, profiler.end_run(saved_profile, alignment_file)
+
+    return discovery_lines(alignment_file), None
+
+
+def discovery_lines(alignment_file):
+
+    options_object = copy.copy(batch_settings["options"])
+    options_object.single_alignment = alignment_file
+
+    gene_writer = discovery_writer(None)
+
+    try:
+        sliced_alignment = runslice(options_object, c_threshold = batch_settings["c_threshold"], trait_object = batch_settings["trait_object"])
+
+        discovery(
+                    input_cfg = options_object.config_file,
+                    sliced_object = sliced_alignment,
+
+                    max_fg_gaps = options_object.max_fg_gaps_string,
+                    max_bg_gaps = options_object.max_bg_gaps_string,
+                    max_overall_gaps = options_object.max_gaps_string,
+
+                    max_fg_miss = options_object.max_fg_miss_string,
+                    max_bg_miss = options_object.max_bg_miss_string,
+                    max_overall_miss = options_object.max_miss_string,
+
+                    admitted_patterns = options_object.patterns_string,
+                    output_file = gene_writer,
+                    trait_object = batch_settings["trait_object"],
+                    engine = options_object.engine,
+                    chunk_size = column_chunk(options_object))
+
+    except Exception as e:
+        print("****ERROR: could not scan", alignment_file + ":", e)
+        return []
+
+    return gene_writer.lines
+
+
+# FUNCTION batch_discovery()
+# Distributes the alignments across the workers and writes all the CAAS in one table. Returns the number of CAAS.
+# With a profile_runs list (--profile), the profile reports of the alignments are appended to it.
+
+def batch_discovery(options_object, alignments, ncores, output_file, trait_object = None, profile_runs = None):
+
+    # Step 1: load and compile the traits (unless the caller already did) and calculate the column threshold once for all the alignments
+
+    if trait_object == None:
+        trait_object = load_traits(options_object.config_file)
+
+    compile_traits(trait_object)
+    c_threshold = column_threshold(options_object, trait_object)
+
+    # Step 2: open the output stream (one for the whole batch)
+
+    if output_file != "-" and exists(output_file):
+        os.remove(output_file)
+
+    output_writer = discovery_writer(output_file)
+
+    # Step 3: scan the alignments. The gene outputs are written as they arrive, in the same order of the alignment list.
+
+    settings = (options_object, trait_object, c_threshold)
+
+    if ncores > 1:
+        pool = multiprocessing.Pool(ncores, initializer = init_worker, initargs = settings)
+        gene_outputs = pool.imap(discovery_on_alignment, alignments, chunksize = 1)
+    else:
+        init_worker(*settings)
+        gene_outputs = map(discovery_on_alignment, alignments)
+
+    for gene_lines, gene_profile in gene_outputs:
+        for line in gene_lines:
+            output_writer.write(line)
+
+        if gene_profile != None and profile_runs != None:
+            profile_runs.append(gene_profile)
+
+    if ncores > 1:
+        pool.close()
+        pool.join()
+
+    output_writer.close()
+
+    return output_writer.rows
+
+
+# The bootstrap settings. The resampled traits are loaded once by the parent process: with the fork start method
+# the workers inherit them (copy-on-write, binary cycles files are memory-mapped), otherwise each worker loads them.
+
+boot_settings = {}
+
+def init_boot_worker(options_object, c_threshold):
+
+    if options_object.output_file == "-":
+        sys.stdout = sys.stderr
+
+    boot_settings["options"] = options_object
+    boot_settings["c_threshold"] = c_threshold
+
+    if getattr(options_object, "profile", "none") != "none" and not profiler.enabled:
+        profiler.enable_profile()
+
+    boot_settings["early_stop"] = None
+    boot_settings["targets"] = None
+
+    if getattr(options_object, "targets", "none") != "none":
+        boot_settings["targets"] = load_targets(options_object.targets)
+
+    if getattr(options_object, "early_stop", "none") != "none":
+        boot_settings["early_stop"] = int(options_object.early_stop)
+
+    if "resampled_traits" not in boot_settings:
+        boot_settings["resampled_traits"] = simtrait_revive(options_object.simtraits)
+
+
+# FUNCTION bootstrap_on_alignment()
+# Slices one alignment and runs the bootstrap on it. Returns the output lines of the gene and its profile report (None
+# without --profile).
+
+def bootstrap_on_alignment(alignment_file):
+
+    if profiler.enabled:
+        saved_profile = profiler.start_run()
+        gene_lines = bootstrap_lines(alignment_file)
+        return gene_lines, profiler.end_run(saved_profile, alignment_file)
+
+    return bootstrap_lines(alignment_file), None
+
+
+def bootstrap_lines(alignment_file):
+
+    options_object = copy.copy(boot_settings["options"])
+    options_object.single_alignment = alignment_file
+
+    # Targeted bootstrap: only the CAAS positions of the gene (no CAAS, no bootstrap)
+
+    positions = None
+
+    if boot_settings["targets"] != None:
+        positions = boot_settings["targets"].get(alignment_genename(alignment_file))
+
+        if positions == None:
+            return []
+
+    try:
+        sliced_alignment = runslice(options_object, c_threshold = boot_settings["c_threshold"], positions = positions)
+
+        gene_lines = boot_on_single_alignment(
+                    trait_config_file = options_object.config_file,
+                    resampled_traits = boot_settings["resampled_traits"],
+                    sliced_object = sliced_alignment,
+
+                    max_fg_gaps = options_object.max_fg_gaps_string,
+                    max_bg_gaps = options_object.max_bg_gaps_string,
+                    max_overall_gaps = options_object.max_gaps_string,
+
+                    max_fg_miss = options_object.max_fg_miss_string,
+                    max_bg_miss = options_object.max_bg_miss_string,
+                    max_overall_miss = options_object.max_miss_string,
+
+                    the_admitted_patterns = options_object.patterns_string,
+                    output_file = None,
+                    engine = options_object.engine,
+                    early_stop = boot_settings["early_stop"],
+                    chunk_size = column_chunk(options_object))
+
+    except Exception as e:
+        print("****ERROR: could not bootstrap", alignment_file + ":", e)
+        return []
+
+    return gene_lines
+
+
+# FUNCTION batch_bootstrap()
+# Loads the resampled traits once, distributes the alignments across the workers and writes one bootstrap table.
+# Returns the number of bootstrapped positions. With a profile_runs list (--profile), the profile reports of the
+# alignments are appended to it.
+
+def batch_bootstrap(options_object, alignments, ncores, output_file, profile_runs = None):
+
+    # Step 1: load the resampled traits and calculate the column threshold once for all the alignments
+
+    with profiler.stage("load_cycles"):
+        boot_settings["resampled_traits"] = simtrait_revive(options_object.simtraits)
+
+    c_threshold = column_threshold(options_object)
+
+    print("caastools found", boot_settings["resampled_traits"].cycles, "resamplings")
+
+    # Step 2: scan the alignments. The gene outputs are written as they arrive, in the same order of the alignment list.
+
+    settings = (options_object, c_threshold)
+
+    if ncores > 1:
+        pool = multiprocessing.Pool(ncores, initializer = init_boot_worker, initargs = settings)
+        gene_outputs = pool.imap(bootstrap_on_alignment, alignments, chunksize = 1)
+    else:
+        init_boot_worker(*settings)
+        gene_outputs = map(bootstrap_on_alignment, alignments)
+
+    if output_file == "-":
+        output_handle = sys.__stdout__
+    else:
+        output_handle = open(output_file, "w", buffering = 1048576)
+
+    rows = 0
+    print_line = profiler.profiled(print, "output")
+
+    for gene_lines, gene_profile in gene_outputs:
+        for line in gene_lines:
+            print_line(line, file = output_handle)
+            rows += 1
+
+        if gene_profile != None and profile_runs != None:
+            profile_runs.append(gene_profile)
+
+    if ncores > 1:
+        pool.close()
+        pool.join()
+
+    if output_file == "-":
+        output_handle.flush()
+    else:
+        output_handle.close()
+
+    return rows
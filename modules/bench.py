@@ -0,0 +1,444 @@
+#                      _              _
+#                     | |            | |
+#   ___ __ _  __ _ ___| |_ ___   ___ | |___
+#  / __/ _` |/ _` / __| __/ _ \ / _ \| / __|
+# | (_| (_| | (_| \__ \ || (_) | (_) | \__ \
+#  \___\__,_|\__,_|___/\__\___/ \___/|_|___/
+
+
+'''
+A Convergent Amino Acid Substitution identification
+and analysis toolbox
+
+Author:         Fabio Barteri (fabio.barteri@upf.edu)
+
+Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
+                Xavier Farré (xfarrer@igtp.cat),
+                David de Juan (david.juan@upf.edu).
+
+MODULE NAME:    bench.py
+DESCRIPTION:    Benchmark suite. Generates synthetic MSAs, traits, trees and cycles of
+                any size, times the stages of discovery, resample and bootstrap on them
+                (and on a fixed set of test MSAs) and compares the throughputs with a
+                saved baseline report.
+DEPENDENCIES:   alimport, caas_id, fastcaas, hyper, boot, fastboot, init_bootstrap, pindex
+CALLED BY:      ct
+
+TABLE OF CONTENTS
+------------------------------------------
+synthetic_species()         Names of the synthetic species.
+
+synthetic_tree()            Writes a random binary tree of the species (newick).
+
+synthetic_trait()           Writes a trait config file with random fg and bg species.
+
+synthetic_alignment()       Writes a random MSA (phylip-relaxed) with a given gap
+                            rate and a share of convergent columns.
+
+synthetic_case()            Writes all the inputs of a synthetic benchmark.
+
+real_case()                 The inputs of the real-data benchmark (test/msa).
+
+clear_pvalue_caches()       Empties the pvalue caches.
+
+time_stage()                Best wall time of a stage over some repeats.
+
+run_case()                  Times all the stages of a benchmark case.
+
+compare_reports()           Compares the throughputs of a report with a baseline.
+
+print_report()              Prints the throughputs of a report (and the comparison).
+'''
+
+from modules.alimport import slice, read_alignment, GAP
+from modules.caas_id import process_position, fetch_caas, discovery_writer
+from modules.fastcaas import fetch_caas_matrix
+from modules.hyper import calcpval_random, pvalue_signature, hypergeom_pmf
+from modules.boot import caasboot
+from modules.fastboot import caasboot_matrix
+from modules.init_bootstrap import simtrait, simtrait_revive
+from modules.pindex import load_traits, compile_traits
+
+import os
+import sys
+import glob
+import time
+import platform
+import itertools
+import contextlib
+import numpy as np
+
+
+BENCH_VERSION = "1"
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+# The real-data case: the first alignments of test/msa, the body mass trait and the phylogeny-restricted cycles
+
+REAL_CASE_GENES = 25
+REAL_CASE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test")
+
+# The stages, in running order, and their throughput unit
+
+STAGES = [
+    ("slice", "columns/s"),
+    ("process_position", "columns/s"),
+    ("fetch_caas", "columns/s"),
+    ("fetch_caas_matrix", "columns/s"),
+    ("calcpval_random", "columns/s"),
+    ("simtrait", "cycles/s"),
+    ("caasboot", "cycles*columns/s"),
+    ("caasboot_matrix", "cycles*columns/s")
+]
+
+
+# FUNCTION synthetic_species()
+# Names of the synthetic species (sp001, sp002...)
+
+def synthetic_species(nspecies):
+
+    digits = len(str(nspecies))
+
+    return ["sp" + str(i).zfill(digits) for i in range(1, nspecies + 1)]
+
+
+# FUNCTION synthetic_tree()
+# Writes a random binary tree of the species (newick), joining random pairs of subtrees with random branch lengths
+
+def synthetic_tree(output_file, species, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    subtrees = list(species)
+
+    while len(subtrees) > 1:
+        a, b = sorted(rng.choice(len(subtrees), 2, replace = False), reverse = True)
+        la, lb = rng.exponential(0.1, 2)
+
+        joined = "(" + subtrees[a] + ":" + str(round(la, 6)) + "," + subtrees[b] + ":" + str(round(lb, 6)) + ")"
+
+        subtrees.pop(a)
+        subtrees.pop(b)
+        subtrees.append(joined)
+
+    with open(output_file, "w") as tree_handle:
+        print(subtrees[0] + ";", file = tree_handle)
+
+
+# FUNCTION synthetic_trait()
+# Writes a trait config file with fg_size random foreground species and bg_size random background species.
+# Returns the foreground and the background species.
+
+def synthetic_trait(output_file, species, fg_size, bg_size, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    picked = [species[x] for x in rng.permutation(len(species))[:fg_size + bg_size]]
+
+    fg = sorted(picked[:fg_size])
+    bg = sorted(picked[fg_size:])
+
+    with open(output_file, "w") as cfg_handle:
+        for x in fg:
+            print(x + "\t1", file = cfg_handle)
+        for x in bg:
+            print(x + "\t0", file = cfg_handle)
+
+    return fg, bg
+
+
+# FUNCTION synthetic_alignment()
+# Writes a random MSA (phylip-relaxed). Each column draws its residues from 1 to 4 random amino acids. A share
+# (caas_rate) of the columns is convergent: one amino acid in the foreground species, another one in the background.
+# Then every residue is a gap with probability gap_rate.
+
+def synthetic_alignment(output_file, species, ncolumns, gap_rate, fg = [], bg = [], caas_rate = 0.02, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    nspecies = len(species)
+    codes = np.frombuffer(AMINO_ACIDS.encode(), dtype = np.uint8)
+
+    alphabets = rng.permuted(np.tile(codes, (ncolumns, 1)), axis = 1)[:, :4]
+    alphabet_size = rng.integers(1, 5, ncolumns)
+
+    picks = (rng.random((nspecies, ncolumns)) * alphabet_size).astype(np.int64)
+    matrix = alphabets[np.arange(ncolumns)[np.newaxis, :], picks]
+
+    # Convergent columns
+
+    species_index = dict(zip(species, range(nspecies)))
+    convergent = np.flatnonzero(rng.random(ncolumns) < caas_rate)
+
+    if len(fg) > 0 and len(bg) > 0:
+        fg_rows = np.array([species_index[x] for x in fg])
+        bg_rows = np.array([species_index[x] for x in bg])
+
+        matrix[np.ix_(fg_rows, convergent)] = alphabets[convergent, 0]
+        matrix[np.ix_(bg_rows, convergent)] = alphabets[convergent, 1]
+
+    # Gaps
+
+    matrix[rng.random((nspecies, ncolumns)) < gap_rate] = GAP
+
+    with open(output_file, "w") as msa_handle:
+        print(str(nspecies) + " " + str(ncolumns), file = msa_handle)
+        for name, row in zip(species, matrix):
+            print(name + " " + row.tobytes().decode(), file = msa_handle)
+
+
+# CLASS benchmark_case
+# The inputs of a benchmark case. Without cycles_file, the bootstrap stages use the cycles resampled by the simtrait stage.
+
+class benchmark_case():
+
+    def __init__(self, name, settings = {}):
+        self.name = name
+        self.settings = dict(settings)
+        self.alignments = []
+        self.alignment_format = "phylip-relaxed"
+        self.config_file = ""
+        self.tree_file = ""
+        self.cycles_file = None
+        self.fg_size = 0
+        self.bg_size = 0
+        self.cycles = 0
+
+
+# FUNCTION synthetic_case()
+# Writes all the inputs of a synthetic benchmark in a directory (MSA, trait config file and tree). Returns the case.
+
+def synthetic_case(directory, nspecies = 100, ncolumns = 5000, gap_rate = 0.1, cycles = 1000, fg_size = 10, bg_size = 10, seed = 0):
+
+    z = benchmark_case("synthetic", {"species" : nspecies, "columns" : ncolumns, "gap_rate" : gap_rate, "cycles" : cycles, "fg_size" : fg_size, "bg_size" : bg_size, "seed" : seed})
+
+    z.fg_size = fg_size
+    z.bg_size = bg_size
+    z.cycles = cycles
+
+    species = synthetic_species(nspecies)
+
+    z.tree_file = os.path.join(directory, "synthetic.tree.nh")
+    z.config_file = os.path.join(directory, "synthetic.cfg")
+    z.alignments = [os.path.join(directory, "synthetic.phy")]
+
+    synthetic_tree(z.tree_file, species, seed)
+    fg, bg = synthetic_trait(z.config_file, species, fg_size, bg_size, seed)
+    synthetic_alignment(z.alignments[0], species, ncolumns, gap_rate, fg, bg, seed = seed)
+
+    return z
+
+
+# FUNCTION real_case()
+# The inputs of the real-data benchmark: the first REAL_CASE_GENES alignments of test/msa, the body mass trait and the
+# phylogeny-restricted cycles of the tests. The simtrait stage resamples (random mode) on the species tree of the tests.
+
+def real_case(cycles = 1000):
+
+    z = benchmark_case("real")
+
+    z.alignments = sorted(glob.glob(os.path.join(REAL_CASE_DIR, "msa", "*")))[:REAL_CASE_GENES]
+    z.config_file = os.path.join(REAL_CASE_DIR, "BodyMass_kg_permulation.cfg")
+    z.tree_file = os.path.join(REAL_CASE_DIR, "traits.speciestree.210512.nh")
+    z.cycles_file = os.path.join(REAL_CASE_DIR, "strap", "drawer", "phylorest.tab")
+    z.cycles = cycles
+
+    index = compile_traits(load_traits(z.config_file))
+    trait = index.traits[0]
+
+    z.fg_size = len(index.fg_ids[trait])
+    z.bg_size = len(index.bg_ids[trait])
+    z.settings = {"genes" : len(z.alignments), "cycles" : cycles, "fg_size" : z.fg_size, "bg_size" : z.bg_size}
+
+    return z
+
+
+# FUNCTION clear_pvalue_caches()
+# Empties the pvalue caches: the stages that calculate pvalues start cold, whatever the stages run before them
+
+def clear_pvalue_caches():
+
+    pvalue_signature.cache_clear()
+    hypergeom_pmf.cache_clear()
+
+
+# FUNCTION time_stage()
+# Best wall time of a stage over some repeats (the messages of the stage are silenced). Returns the seconds and the
+# value returned by the last run.
+
+def time_stage(stage, repeats = 3):
+
+    best = None
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(repeats):
+            start = time.perf_counter()
+            value = stage()
+            seconds = time.perf_counter() - start
+
+            if best == None or seconds < best:
+                best = seconds
+
+    return best, value
+
+
+# FUNCTION run_case()
+# Times all the stages of a benchmark case. The classic (position by position) stages only run on the first
+# classic_columns kept columns of the case. Returns the report (a dictionary, see print_report()).
+
+def run_case(case, work_directory, repeats = 3, classic_columns = 200):
+
+    report = {"version" : BENCH_VERSION, "case" : case.name, "repeats" : repeats, "settings" : dict(case.settings, classic_columns = classic_columns), "workload" : {}, "machine" : {}, "stages" : {}}
+
+    report["machine"] = {"python" : platform.python_version(), "numpy" : np.__version__, "platform" : platform.platform(), "processor" : platform.processor()}
+
+    def record(stage, seconds, work):
+        unit = dict(STAGES)[stage]
+        report["stages"][stage] = {"seconds" : seconds, "work" : work, "unit" : unit, "throughput" : work / seconds if seconds > 0 else 0.0}
+
+    # The trait and the column threshold (no gaps and missing species allowed)
+
+    trait_object = load_traits(case.config_file)
+    index = compile_traits(trait_object)
+    c_threshold = min([min(len(index.fg_ids[x]), len(index.bg_ids[x])) for x in index.traits])
+
+    # Stage 1: parsing and slicing
+
+    columns = sum([read_alignment(x, case.alignment_format)[1].shape[1] for x in case.alignments])
+
+    seconds, sliced = time_stage(lambda : [slice(x, case.alignment_format, c_threshold) for x in case.alignments], repeats)
+    record("slice", seconds, columns)
+
+    kept = sum([len(x.positions) for x in sliced])
+    classic = []
+
+    for x in sliced:
+        classic.append(list(itertools.islice(x.iter_positions(), classic_columns - sum([len(y) for y in classic]))))
+
+    classic_kept = sum([len(x) for x in classic])
+
+    report["workload"]["kept_columns"] = kept
+
+    # Stage 2: classic discovery (position processing, then the CAAS test, pvalues included)
+
+    def processing():
+        return [[process_position(p, trait_object, x.species) for p in positions] for x, positions in zip(sliced, classic)]
+
+    seconds, processed = time_stage(processing, repeats)
+    record("process_position", seconds, classic_kept)
+
+    def classic_discovery():
+        clear_pvalue_caches()
+        writer = discovery_writer(None)
+        for x, positions in zip(sliced, processed):
+            for p in positions:
+                fetch_caas(x.genename, p, trait_object.alltraits, writer, "NO", "NO", "NO", "NO", "NO", "NO", "1,2,3")
+        return writer
+
+    seconds, writer = time_stage(classic_discovery, repeats)
+    record("fetch_caas", seconds, classic_kept)
+
+    # Stage 3: vector discovery
+
+    def vector_discovery():
+        clear_pvalue_caches()
+        writer = discovery_writer(None)
+        for x in sliced:
+            fetch_caas_matrix(x, trait_object, trait_object.alltraits, writer, "NO", "NO", "NO", "NO", "NO", "NO", "1,2,3")
+        return writer
+
+    seconds, writer = time_stage(vector_discovery, repeats)
+    record("fetch_caas_matrix", seconds, kept)
+    report["workload"]["caas"] = writer.rows
+
+    # Stage 4: the pvalues of all the kept columns (cold caches at every repeat)
+
+    positions = [p for x in sliced for p in x.iter_positions()]
+
+    def pvalues():
+        clear_pvalue_caches()
+        return [calcpval_random(p, "", case.fg_size, case.bg_size) for p in positions]
+
+    seconds, values = time_stage(pvalues, repeats)
+    record("calcpval_random", seconds, len(positions))
+
+    # Stage 5: resampling (random mode, on the tree of the case)
+
+    tab_file = os.path.join(work_directory, case.name + ".cycles.tab")
+    binary_file = os.path.join(work_directory, case.name + ".cycles.bin")
+
+    seconds, resampled = time_stage(lambda : simtrait(case.fg_size, case.bg_size, "none", case.tree_file, "random", "none", "none", case.cycles, tab_file, seed = 0, binary_outfile = binary_file), repeats)
+    record("simtrait", seconds, case.cycles)
+
+    # Stage 6: bootstrap, classic and vector engines
+
+    cycles_file = case.cycles_file if case.cycles_file != None else binary_file
+    resampled_traits = simtrait_revive(cycles_file)
+    report["workload"]["bootstrap_cycles"] = resampled_traits.cycles
+
+    # The classic engine needs the trait dictionaries (built on request for binary cycles): they are built before timing
+    resampled_traits.trait2fg
+    resampled_traits.trait2bg
+
+    def classic_bootstrap():
+        return [[caasboot(p, x.genename, resampled_traits.alltraits, "NO", "NO", "NO", "NO", "NO", "NO", resampled_traits.cycles, "1,2,3") for p in [process_position(q, resampled_traits, x.species) for q in positions]] for x, positions in zip(sliced, classic)]
+
+    seconds, lines = time_stage(classic_bootstrap, repeats)
+    record("caasboot", seconds, resampled_traits.cycles * classic_kept)
+
+    def vector_bootstrap():
+        return [list(caasboot_matrix(x, resampled_traits, "NO", "NO", "NO", "NO", "NO", "NO", resampled_traits.cycles, "1,2,3")) for x in sliced]
+
+    seconds, lines = time_stage(vector_bootstrap, repeats)
+    record("caasboot_matrix", seconds, resampled_traits.cycles * kept)
+
+    return report
+
+
+# FUNCTION compare_reports()
+# Compares the throughputs of the stages of a report with a baseline report of the same case and settings.
+# Returns a list of (stage, baseline throughput, throughput, ratio, regression) tuples, empty if the cases can't be compared.
+# A stage is a regression if its throughput is below (1 - tolerance) times the baseline one.
+
+def compare_reports(report, baseline, tolerance = 0.2):
+
+    if baseline.get("version") != report["version"] or baseline.get("case") != report["case"] or baseline.get("settings") != report["settings"]:
+        return []
+
+    comparison = []
+
+    for stage, unit in STAGES:
+        if stage in report["stages"] and stage in baseline["stages"]:
+            old = baseline["stages"][stage]["throughput"]
+            new = report["stages"][stage]["throughput"]
+            ratio = new / old if old > 0 else float("inf")
+
+            comparison.append((stage, old, new, ratio, ratio < 1 - tolerance))
+
+    return comparison
+
+
+# FUNCTION print_report()
+# Prints the throughputs of a report, with the ratios over the baseline if a comparison is given
+
+def print_report(report, comparison = None, output_handle = sys.stdout):
+
+    settings = ", ".join([x + " " + str(y) for x, y in list(report["settings"].items()) + list(report["workload"].items())])
+    print("[BENCHMARK] - case", report["case"], "(" + settings + ")", file = output_handle)
+
+    ratios = {}
+
+    if comparison != None:
+        ratios = {x[0] : x for x in comparison}
+
+    for stage, unit in STAGES:
+
+        if stage not in report["stages"]:
+            continue
+
+        s = report["stages"][stage]
+        line = "    " + stage.ljust(20) + ("%.4g" % s["throughput"]).rjust(12) + " " + unit.ljust(18) + ("%.3f s" % s["seconds"]).rjust(10)
+
+        if stage in ratios:
+            line += ("   x%.2f" % ratios[stage][3]) + ("   ****REGRESSION" if ratios[stage][4] else "")
+
+        print(line, file = output_handle)
+
+    print("", file = output_handle)
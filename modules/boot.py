@@ -19,7 +19,7 @@ Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
 
 MODULE NAME: boot.py
 DESCRIPTION: bootstrap function
-DEPENDENCIES: alimport.py, caas_id.py, pindex.py
+DEPENDENCIES: alimport.py, caas_id.py, fastboot.py, pindex.py
 CALLED BY: ct
 
 '''
@@ -29,6 +29,8 @@ from modules.init_bootstrap import *
 from modules.disco import process_position
 from modules.caas_id import iscaas
 from modules.alimport import *
+from modules.fastboot import caasboot_matrix
+from modules import profiler
 
 from os.path import exists
 import functools
@@ -101,7 +103,7 @@ def caasboot(processed_position, genename, list_of_traits, maxgaps_fg, maxgaps_b
 
         if maxgaps_fg != "NO" and processed_position.trait2gaps_fg[trait] > int(maxgaps_fg):
             return False
-        if maxgaps_bg != "NO" and processed_position.trait2gaps_bg[trait] > int(maxgaps_fg):
+        if maxgaps_bg != "NO" and processed_position.trait2gaps_bg[trait] > int(maxgaps_bg):
             return False
         if maxgaps_all != "NO" and processed_position.trait2gaps_fg[trait] + processed_position.trait2gaps_bg[trait] > int(maxgaps_all):
            return False
@@ -110,7 +112,7 @@ def caasboot(processed_position, genename, list_of_traits, maxgaps_fg, maxgaps_b
         
         if maxmiss_fg != "NO" and processed_position.trait2miss_fg[trait] > int(maxmiss_fg):
             return False
-        if maxmiss_bg != "NO" and processed_position.trait2miss_bg[trait] > int(maxmiss_fg):
+        if maxmiss_bg != "NO" and processed_position.trait2miss_bg[trait] > int(maxmiss_bg):
             return False
         if maxmiss_all != "NO" and processed_position.trait2miss_fg[trait] + processed_position.trait2miss_bg[trait] > int(maxmiss_all):
             return False
@@ -162,23 +164,23 @@ def caasboot(processed_position, genename, list_of_traits, maxgaps_fg, maxgaps_b
         
 
 # FUNCTION disco_bootstrap()
-# Launches the bootstrap in several lines. Returns a dictionary gene@position --> pvalue
+# Launches the bootstrap in several lines. The lines are streamed to output_file as they are produced (chunk by chunk)
+# and the number of lines is returned. With no output_file (None, e.g. in batch mode) the lines are returned instead.
 
-def boot_on_single_alignment(trait_config_file, resampled_traits, sliced_object, max_fg_gaps, max_bg_gaps, max_overall_gaps, max_fg_miss, max_bg_miss, max_overall_miss, the_admitted_patterns, output_file):
+def boot_on_single_alignment(trait_config_file, resampled_traits, sliced_object, max_fg_gaps, max_bg_gaps, max_overall_gaps, max_fg_miss, max_bg_miss, max_overall_miss, the_admitted_patterns, output_file, engine = "vector", ncores = 1, early_stop = None, chunk_size = COLUMN_CHUNK):
 
 
-    # Step 3: processes the positions from imported alignment (process_position() from caas_id.py)
-    processed_positions = map(functools.partial(process_position, multiconfig = resampled_traits, species_in_alignment = sliced_object.species), sliced_object.d)
     the_genename = sliced_object.genename
     print("caastools found", resampled_traits.cycles, "resamplings")
 
-    # Step 4: extract the raw caas
+    # Step 4: extract the raw caas. The vector engine evaluates all the cycles at once on each column (fastboot.py),
+    # split in ncores blocks of cycles evaluated in parallel, or sequentially with early stopping (early_stop positive cycles).
+    # Both engines are lazy: the columns are evaluated while the lines are written.
 
-    output_lines = map(
-        functools.partial(
-            caasboot,
-            list_of_traits = resampled_traits.alltraits,
-            genename = the_genename,
+    if engine == "vector":
+        output_lines = caasboot_matrix(
+            sliced_object,
+            resampled_traits,
             maxgaps_fg = max_fg_gaps,
             maxgaps_bg = max_bg_gaps,
             maxgaps_all = max_overall_gaps,
@@ -187,18 +189,66 @@ def boot_on_single_alignment(trait_config_file, resampled_traits, sliced_object,
             maxmiss_bg = max_bg_miss,
             maxmiss_all = max_overall_miss,
 
+            cycles = resampled_traits.cycles,
             admitted_patterns = the_admitted_patterns,
-            cycles = resampled_traits.cycles) ,processed_positions
-    )
+            ncores = ncores,
+            early_stop = early_stop,
+            chunk_size = chunk_size)
 
-    output_lines = list(output_lines)
+    else:
 
-    ooout = open(output_file, "w")
+        # Processes the positions from imported alignment (process_position() from caas_id.py), one at a time
+        processed_positions = map(functools.partial(profiler.profiled(process_position, "process_position"), multiconfig = resampled_traits, species_in_alignment = sliced_object.species), sliced_object.iter_positions())
+
+        output_lines = map(
+            functools.partial(
+                profiler.profiled(caasboot, "caasboot"),
+                list_of_traits = resampled_traits.alltraits,
+                genename = the_genename,
+                maxgaps_fg = max_fg_gaps,
+                maxgaps_bg = max_bg_gaps,
+                maxgaps_all = max_overall_gaps,
+
+                maxmiss_fg = max_fg_miss,
+                maxmiss_bg = max_bg_miss,
+                maxmiss_all = max_overall_miss,
+
+                admitted_patterns = the_admitted_patterns,
+                cycles = resampled_traits.cycles) ,processed_positions
+        )
+
+    if profiler.enabled:
+        output_lines = profiled_bootstrap(output_lines)
+
+    output_lines = (line + "\t" + trait_config_file for line in output_lines)
+
+    # Step 5: print the output (unless output_file is None, e.g. in batch mode: the lines are only returned)
+
+    if output_file == None:
+        return list(output_lines)
+
+    rows = 0
+    print_line = profiler.profiled(print, "output")
+
+    with open(output_file, "w", buffering = 1048576) as ooout:
+        for line in output_lines:
+            print_line(line, file=ooout)
+            rows += 1
+
+    return rows
+
+# FUNCTION profiled_bootstrap()
+# The bootstrap lines of an alignment, with the time spent to produce them (the bootstrap stage, --profile), the number
+# of positions and the number of cycles evaluated (with early stopping, less than positions x cycles)
+
+def profiled_bootstrap(output_lines):
+
+    for line in profiler.profiled_iterator(output_lines, "bootstrap"):
+        profiler.count("bootstrap_positions")
+        profiler.count("bootstrap_cycles_evaluated", line.split("\t")[2])
+
+        yield line
 
-    for line in output_lines:
-        print(line + "\t" + trait_config_file, file=ooout)
-    
-    ooout.close()
 
 # FUNCTION pval()
 # Returns a dictionary with the pvalue
@@ -216,4 +266,34 @@ def pval(bootstrap_result):
         except:
             pass
     
-    return d
\ No newline at end of file
+    return d
+
+
+# FUNCTION load_targets()
+# Reads the CAAS positions of a discovery table (ct discovery output, plain or gzip compressed).
+# Returns a dictionary gene --> set of positions
+
+def load_targets(discovery_table):
+
+    if discovery_table.endswith(".gz"):
+        import gzip
+        table_handle = gzip.open(discovery_table, "rt")
+    else:
+        table_handle = open(discovery_table)
+
+    targets = {}
+
+    with table_handle:
+        for line in table_handle:
+            try:
+                c = line.split("\t")
+                position = int(c[2])
+            except:
+                continue                # Header and malformed lines
+
+            try:
+                targets[c[0]].add(position)
+            except:
+                targets[c[0]] = set([position])
+
+    return targets
@@ -31,13 +31,91 @@ process_position()          processes a position from an imported alignment.
 
 check_pattern()            checks the pattern
 
+discovery_writer            the output stream of a discovery run (opened once,
+                            buffered, header printed once).
+
 fetch_caas()                fetches caas per each thing
 '''                                                       
 
 from modules.pindex import *
 from modules.alimport import *
 from modules.hyper import *
+from modules import profiler
 from os.path import exists
+import sys
+import gzip
+
+# The header of the discovery output table
+
+discovery_header = "\t".join([
+    "Gene",
+    "Trait",
+    "Position",
+    "Substitution",
+    "Pvalue",
+    "Pattern",
+    "FFGN",
+    "FBGN",
+    "GFG",
+    "GBG",
+    "MFG",
+    "MBG",
+    "FFG",
+    "FBG",
+    "MS"
+])
+
+# CLASS discovery_writer
+# The output stream of a discovery run. The file is opened at the first CAAS (no CAAS, no output file),
+# the header is printed once and the rows are buffered and flushed every flush_every rows.
+# Output "-" is the standard output, a ".gz" output is gzip compressed and no output (None) keeps the rows in memory.
+
+class discovery_writer():
+
+    def __init__(self, output_file, flush_every = 1000):
+        self.output_file = output_file
+        self.flush_every = flush_every
+        self.handle = None
+        self.rows = 0
+        self.lines = []
+
+    def open(self):
+        if self.output_file == "-":
+            self.handle = sys.__stdout__
+        elif self.output_file.endswith(".gz"):
+            self.handle = gzip.open(self.output_file, "wt")
+        else:
+            self.handle = open(self.output_file, "w", buffering = 1048576)
+
+        print(discovery_header, file = self.handle)
+
+    def write(self, line):
+        self.rows += 1
+
+        if self.output_file == None:
+            self.lines.append(line)
+            return
+
+        with profiler.stage("output"):
+            if self.handle == None:
+                self.open()
+
+            print(line, file = self.handle)
+
+            if self.flush_every > 0 and self.rows % self.flush_every == 0:
+                self.handle.flush()
+
+    def close(self):
+        if self.handle == None:
+            return
+
+        with profiler.stage("output"):
+            if self.output_file == "-":
+                self.handle.flush()
+            else:
+                self.handle.close()
+
+        self.handle = None
 
 # Function process_position()
 # processes a position from an imported alignment. The output will be
@@ -77,8 +155,9 @@ def process_position(position, multiconfig, species_in_alignment):
 
     # Load missing species
 
-    confirmed_species = set(multiconfig.s2t.keys()).intersection(set(species_in_alignment))
-    z.missing = list(set(multiconfig.s2t.keys()) -  confirmed_species)
+    index = compile_traits(multiconfig)
+
+    z.missing = list(index.species_set.difference(species_in_alignment))
 
     # Load aas2species
     for x in position.keys():
@@ -88,32 +167,29 @@ def process_position(position, multiconfig, species_in_alignment):
         except:
             z.aas2species[position[x].split("@")[0]] = [x]
 
-    # Load aas2traits    
+    # Load aas2traits (the (trait, group) pairs of the species sharing each amino acid)
     for key in z.aas2species.keys():
-        traits = []
+        traits = {}
         for species in z.aas2species[key]:
-            try:
-                for v in multiconfig.s2t[species]:
-                    if v not in traits:
-                        traits.append(v)
-            except:
-                pass
-        
-        z.aas2traits[key] = traits
+            for v in index.species_groups.get(species, []):
+                traits[v] = True
+
+        z.aas2traits[key] = list(traits)
 
-        for t in traits:
-            if t[-2:] == "_1" and key != "-":
+        if key == "-":
+            continue
+
+        for trait, group in traits:
+            if group == "1":
                 try:
-                    z.trait2aas_fg[t[:-2]].append(key)
+                    z.trait2aas_fg[trait].append(key)
                 except:
-                    z.trait2aas_fg[t[:-2]] = [key]
-                    pass
-            if t[-2:] == "_0" and key != "-":
+                    z.trait2aas_fg[trait] = [key]
+            else:
                 try:
-                    z.trait2aas_bg[t[:-2]].append(key)
+                    z.trait2aas_bg[trait].append(key)
                 except:
-                    z.trait2aas_bg[t[:-2]] = [key]
-                    pass
+                    z.trait2aas_bg[trait] = [key]
 
     try:
         z.gapped = z.aas2species["-"]
@@ -122,24 +198,26 @@ def process_position(position, multiconfig, species_in_alignment):
 
     # Determine Ungapped Species
 
+    nulls = set(z.gapped + z.missing)
+
     for trait in z.trait2aas_bg.keys():
         
         # Present species (ungapped or missing)
 
-        pfg = list(set(multiconfig.trait2fg[trait]) - set(z.gapped + z.missing))
+        pfg = list(index.fg_set[trait] - nulls)
         z.trait2ungapped_fg[trait] = pfg
 
-        pbg = list(set(multiconfig.trait2bg[trait]) - set(z.gapped + z.missing))
+        pbg = list(index.bg_set[trait] - nulls)
         z.trait2ungapped_bg[trait] = pbg
 
         # Missing in alignment
 
-        miss_fg = list(set(multiconfig.trait2fg[trait]).intersection(set(z.missing)))
-        miss_bg = list(set(multiconfig.trait2bg[trait]).intersection(set(z.missing)))
+        miss_fg = list(index.fg_set[trait].intersection(z.missing))
+        miss_bg = list(index.bg_set[trait].intersection(z.missing))
 
         # Number of gaps
-        gfg = len(set(multiconfig.trait2fg[trait]).intersection(set(z.gapped)))
-        gbg = len(set(multiconfig.trait2bg[trait]).intersection(set(z.gapped)))
+        gfg = len(index.fg_set[trait].intersection(z.gapped))
+        gbg = len(index.bg_set[trait].intersection(z.gapped))
 
         # Number of missings
         mfg = len(miss_fg)
@@ -203,7 +281,7 @@ def iscaas(input_string):
 # FUNCTION fetch_caas():
 # fetches caas per each thing
 
-def fetch_caas(genename, processed_position, list_of_traits, output_file, maxgaps_fg, maxgaps_bg, maxgaps_all, maxmiss_fg, maxmiss_bg, maxmiss_all, admitted_patterns = ["1","2","3"]):
+def fetch_caas(genename, processed_position, list_of_traits, output_writer, maxgaps_fg, maxgaps_bg, maxgaps_all, maxmiss_fg, maxmiss_bg, maxmiss_all, admitted_patterns = ["1","2","3"]):
 
     a = set(list_of_traits)
     b = set(processed_position.trait2aas_fg.keys())
@@ -223,7 +301,7 @@ def fetch_caas(genename, processed_position, list_of_traits, output_file, maxgap
                 if len(valid_traits) > 0:
                     valid_traits.remove(trait)
 
-            if maxgaps_bg != "NO" and processed_position.trait2gaps_bg[trait] > int(maxgaps_fg):
+            if maxgaps_bg != "NO" and processed_position.trait2gaps_bg[trait] > int(maxgaps_bg):
                 if len(valid_traits) > 0:
                     valid_traits.remove(trait)
 
@@ -238,7 +316,7 @@ def fetch_caas(genename, processed_position, list_of_traits, output_file, maxgap
                 if len(valid_traits) > 0:
                     valid_traits.remove(trait)
 
-            if maxmiss_bg != "NO" and processed_position.trait2miss_bg[trait] > int(maxmiss_fg):
+            if maxmiss_bg != "NO" and processed_position.trait2miss_bg[trait] > int(maxmiss_bg):
                 if len(valid_traits) > 0:
                     valid_traits.remove(trait)
 
@@ -289,33 +367,8 @@ def fetch_caas(genename, processed_position, list_of_traits, output_file, maxgap
 
         # Print the output
 
-        header = "\t".join([
-            "Gene",
-            "Trait",
-            "Position",
-            "Substitution",
-            "Pvalue",
-            "Pattern",
-            "FFGN",
-            "FBGN",
-            "GFG",
-            "GBG",
-            "MFG",
-            "MBG",
-            "FFG",
-            "FBG",
-            "MS"
-
-        ])
-
         if len(output_traits) > 0:
 
-            if exists(output_file):
-                out = open(output_file, "a")
-            else:
-                out = open(output_file, "w")
-                print(header, file=out)
-
             for trait in output_traits:
 
                 traitname = trait.split("@")[0]            
@@ -349,7 +402,9 @@ def fetch_caas(genename, processed_position, list_of_traits, output_file, maxgap
 
 
                 #pvalue_string = pvdict[genename + "@" + processed_position.position]
-                print(  "\t".join(
+                profiler.count("caas_" + thepattern)
+
+                output_writer.write(  "\t".join(
                     [genename,
                         traitname,
                         processed_position.position,
@@ -365,7 +420,4 @@ def fetch_caas(genename, processed_position, list_of_traits, output_file, maxgap
                         ",".join(fg_ungapped),
                         ",".join(bg_ungapped),
                         missings]
-                ), file = out)
-            
-
-            out.close()
\ No newline at end of file
+                ))
\ No newline at end of file
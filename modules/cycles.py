@@ -0,0 +1,228 @@
+#                      _              _     
+#                     | |            | |    
+#   ___ __ _  __ _ ___| |_ ___   ___ | |___ 
+#  / __/ _` |/ _` / __| __/ _ \ / _ \| / __|
+# | (_| (_| | (_| \__ \ || (_) | (_) | \__ \
+#  \___\__,_|\__,_|___/\__\___/ \___/|_|___/
+
+
+'''
+A Convergent Amino Acid Substitution identification 
+and analysis toolbox
+
+Author:         Fabio Barteri (fabio.barteri@upf.edu)
+
+Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
+                Xavier Farré (xfarrer@igtp.cat),
+                David de Juan (david.juan@upf.edu).
+
+MODULE NAME:    cycles.py
+DESCRIPTION:    Binary resampled traits (cycles) format. One header line (the format tag
+                and a JSON object with the species table, the cycle names and the matrix
+                offset) followed by a (cycles x species) int8 matrix: 1 for the foreground
+                species of a cycle, 0 for the background ones, -1 for the others.
+DEPENDENCIES:   none
+CALLED BY:      init_bootstrap.py, fastboot.py, ct
+
+TABLE OF CONTENTS
+------------------------------------------
+cycles_writer               Writes a binary cycles file, chunk by chunk.
+
+binary_cycles               The resampled traits object of a binary cycles file
+                            (memory-mapped matrix).
+
+is_binary_cycles()          Tells a binary cycles file from a tab cycles file.
+
+load_cycles()               Loads (memory-maps) a binary cycles file.
+
+convert_cycles()            Converts a tab cycles file (ct resample output)
+                            into a binary cycles file.
+'''
+
+import json
+import numpy as np
+
+
+CYCLES_TAG = "CAASTOOLS-CYCLES-1"
+CYCLES_ALIGNMENT = 64
+
+FG = 1
+BG = 0
+ABSENT = -1
+
+
+# CLASS cycles_writer
+# Writes a binary cycles file. The species and the cycle names are known in advance (they go in the header),
+# the matrix is written in chunks of cycles, so the whole resampling never needs to be in memory.
+
+class cycles_writer():
+
+    def __init__(self, output_file, species, names):
+        self.output_file = output_file
+        self.species = list(species)
+        self.names = list(names)
+        self.rows = 0
+
+        header = CYCLES_TAG + "\t" + json.dumps({"species" : self.species, "names" : self.names})
+
+        # The matrix starts at a multiple of CYCLES_ALIGNMENT bytes (the header line is padded with spaces)
+
+        header = header.encode() + b" "
+        header += b" " * ((-(len(header) + 1)) % CYCLES_ALIGNMENT) + b"\n"
+
+        self.handle = open(output_file, "wb")
+        self.handle.write(header)
+
+    # Writes a chunk of cycles from the fg and bg species indexes (cycles x group size).
+    # Negative indexes pad the shorter groups: they land on an extra column, which is dropped.
+
+    def write_groups(self, fg, bg):
+
+        chunk = np.full((fg.shape[0], len(self.species) + 1), ABSENT, dtype = np.int8)
+        rows = np.arange(fg.shape[0])[:, np.newaxis]
+
+        chunk[rows, fg] = FG
+        chunk[rows, bg] = BG
+
+        self.write(chunk[:, :-1])
+
+    # Writes a chunk of the (cycles x species) matrix
+
+    def write(self, chunk):
+        self.handle.write(np.ascontiguousarray(chunk, dtype = np.int8).tobytes())
+        self.rows += chunk.shape[0]
+
+    def close(self):
+        self.handle.close()
+
+        if self.rows != len(self.names):
+            raise ValueError("Binary cycles file " + self.output_file + ": " + str(self.rows) + " cycles written, " + str(len(self.names)) + " declared")
+
+
+# CLASS binary_cycles
+# The resampled traits object of a binary cycles file. The (cycles x species) matrix is memory-mapped, so the
+# processes reading the same file share the same page-cached data. The trait dictionaries (trait2fg, trait2bg) of
+# the text loader are only built if requested (the classic bootstrap engine needs them, the vector one does not).
+
+class binary_cycles():
+
+    def __init__(self, input_file, species, names, matrix):
+        self.input_file = input_file
+        self.species = species
+        self.alltraits = names
+        self.matrix = matrix
+        self.cycles = len(names)
+
+        self._trait2fg = None
+        self._trait2bg = None
+
+    def groups(self, value):
+        species = np.array(self.species, dtype = object)
+        return dict(zip(self.alltraits, [list(species[row == value]) for row in self.matrix]))
+
+    @property
+    def trait2fg(self):
+        if self._trait2fg == None:
+            self._trait2fg = self.groups(FG)
+        return self._trait2fg
+
+    @property
+    def trait2bg(self):
+        if self._trait2bg == None:
+            self._trait2bg = self.groups(BG)
+        return self._trait2bg
+
+
+# FUNCTION is_binary_cycles()
+# Tells a binary cycles file from a tab cycles file (by the format tag)
+
+def is_binary_cycles(input_file):
+
+    with open(input_file, "rb") as input_handle:
+        return input_handle.read(len(CYCLES_TAG)) == CYCLES_TAG.encode()
+
+
+# FUNCTION load_cycles()
+# Loads a binary cycles file. Only the header is read: the matrix is memory-mapped.
+
+def load_cycles(input_file):
+
+    with open(input_file, "rb") as input_handle:
+        header_line = input_handle.readline()
+
+    tag, header = header_line.decode().split("\t", 1)
+
+    if tag != CYCLES_TAG:
+        raise ValueError(input_file + " is not a binary cycles file")
+
+    header = json.loads(header)
+    shape = (len(header["names"]), len(header["species"]))
+
+    if shape[0] * shape[1] == 0:
+        matrix = np.full(shape, ABSENT, dtype = np.int8)
+    else:
+        matrix = np.memmap(input_file, dtype = np.int8, mode = "r", offset = len(header_line), shape = shape)
+
+    return binary_cycles(input_file, header["species"], header["names"], matrix)
+
+
+# FUNCTION convert_cycles()
+# Converts a tab cycles file (cycle name, comma separated fg species, comma separated bg species) into a binary
+# cycles file. Two passes over the tab file: the first one collects the species and the cycle names, the second one
+# writes the matrix in chunks. Returns the number of cycles.
+
+def convert_cycles(input_file, output_file, chunk_size = 10000):
+
+    def parse(line):
+        c = line.rstrip("\n").split("\t")
+        return c[0], [x for x in c[1].split(",") if x != ""], [x for x in c[2].split(",") if x != ""]
+
+    species_id = {}
+    names = []
+
+    with open(input_file) as input_handle:
+        for line in input_handle:
+            try:
+                name, fg, bg = parse(line)
+            except IndexError:
+                continue
+
+            names.append(name)
+
+            for x in fg + bg:
+                if x not in species_id:
+                    species_id[x] = len(species_id)
+
+    writer = cycles_writer(output_file, species_id.keys(), names)
+    chunk = np.full((min(chunk_size, len(names)), len(species_id)), ABSENT, dtype = np.int8)
+    filled = 0
+
+    with open(input_file) as input_handle:
+        for line in input_handle:
+            try:
+                name, fg, bg = parse(line)
+            except IndexError:
+                continue
+
+            fg_ids = [species_id[x] for x in fg]
+            bg_ids = [species_id[x] for x in bg]
+
+            if len(set(fg_ids).intersection(bg_ids)) > 0:
+                writer.handle.close()
+                raise ValueError("Cycle " + name + " has species in both the foreground and the background")
+
+            chunk[filled, fg_ids] = FG
+            chunk[filled, bg_ids] = BG
+            filled += 1
+
+            if filled == chunk.shape[0]:
+                writer.write(chunk)
+                chunk[:] = ABSENT
+                filled = 0
+
+    if filled > 0:
+        writer.write(chunk[:filled])
+
+    writer.close()
+
+    return len(names)
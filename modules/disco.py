@@ -18,41 +18,54 @@ Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
 
 MODULE NAME: disco.py
 DESCRIPTION: runs the caas discovery on one single alignment. Returns non-validated caas candidate positions.
-DEPENDENCIES: alimport.py, caas_id.py, pindex.py
+DEPENDENCIES: alimport.py, caas_id.py, fastcaas.py, pindex.py
 CALLED BY: CT.
 
 '''
 
 
 from modules.caas_id import *
+from modules.fastcaas import fetch_caas_matrix
 from modules.alimport import *
 from modules.pindex import *
+from modules import profiler
 import os
 from os.path import exists
 
 ### FUNCTION discovery()
 ### Scans one single alignment to identify the CAAS
 
-def discovery(input_cfg, sliced_object, max_fg_gaps, max_bg_gaps, max_overall_gaps, max_fg_miss, max_bg_miss, max_overall_miss, admitted_patterns, output_file):
+def discovery(input_cfg, sliced_object, max_fg_gaps, max_bg_gaps, max_overall_gaps, max_fg_miss, max_bg_miss, max_overall_miss, admitted_patterns, output_file, trait_object = None, engine = "vector", chunk_size = COLUMN_CHUNK):
 
-    # Step 1: import the trait into a trait object (load_cfg from pindex.py)
-    trait_object = load_cfg(input_cfg)
+    # Step 1: import the traits into a trait object (load_traits from pindex.py), unless they were already loaded.
+    # One trait object can hold many traits: all of them are scanned in the same pass over the alignment.
+    if trait_object == None:
+        trait_object = load_traits(input_cfg)
 
     # Step 2: import the alignment int a processed position object (slice from alimport.py)
     p = sliced_object
 
-    # Step 3: processes the positions from imported alignment (process_position() from caas_id.py)
-    processed_positions = map(functools.partial(process_position, multiconfig = trait_object, species_in_alignment = p.species), p.d)
+    # Step 3: Open the output stream, overwriting the output file. A discovery_writer
+    # can also be passed instead of a file name (e.g. the one of a batch run), and it is left open.
 
-    # Step 5: Overwrite the output file
+    if isinstance(output_file, discovery_writer):
+        output_writer = output_file
+    else:
+        output_writer = discovery_writer(output_file)
 
-    if exists(output_file):
-        os.system("rm -r " + output_file)
+        if output_file != "-" and exists(output_file):
+            os.remove(output_file)
 
-    # Step 5: extract the raw caas
-    for position in processed_positions:
-        fetch_caas( p.genename,
-                    position,
+    rows_before = output_writer.rows
+
+    # Step 4: extract the raw caas. The vector engine scans the columns in chunks of chunk_size columns (fastcaas.py);
+    # the classic engine goes position by position and it is used if the alignment can't be encoded.
+
+    done = False
+
+    if engine == "vector":
+        done = profiler.profiled(fetch_caas_matrix, "fetch_caas_matrix")(p,
+                    trait_object,
                     trait_object.alltraits,
 
                     maxgaps_bg= max_bg_gaps,
@@ -64,5 +77,43 @@ def discovery(input_cfg, sliced_object, max_fg_gaps, max_bg_gaps, max_overall_ga
                     maxmiss_all= max_overall_miss,
 
                     admitted_patterns=admitted_patterns,
-                    output_file = output_file
-                    )
\ No newline at end of file
+                    output_writer = output_writer,
+                    chunk_size = chunk_size
+                    )
+
+    if done == False:
+
+        # Processes the positions from imported alignment (process_position() from caas_id.py), one at a time
+        processed_positions = map(functools.partial(profiler.profiled(process_position, "process_position"), multiconfig = trait_object, species_in_alignment = p.species), p.iter_positions())
+        timed_fetch_caas = profiler.profiled(fetch_caas, "fetch_caas")
+
+        for column, position in enumerate(processed_positions):
+
+            # Only the traits for which the column can be a CAAS (see runslice.trait_prefilter())
+            column_traits = trait_object.alltraits
+
+            if p.trait_columns != None:
+                column_traits = [x for x in trait_object.alltraits if x not in p.trait_columns or p.trait_columns[x][column]]
+
+            timed_fetch_caas( p.genename,
+                              position,
+                              column_traits,
+
+                              maxgaps_bg= max_bg_gaps,
+                              maxgaps_fg= max_fg_gaps,
+                              maxgaps_all= max_overall_gaps,
+
+                              maxmiss_bg= max_bg_miss,
+                              maxmiss_fg= max_fg_miss,
+                              maxmiss_all= max_overall_miss,
+
+                              admitted_patterns=admitted_patterns,
+                              output_writer = output_writer
+                              )
+
+    # Step 5: close the output stream (only if this function opened it) and return the number of CAAS
+
+    if output_writer is not output_file:
+        output_writer.close()
+
+    return output_writer.rows - rows_before
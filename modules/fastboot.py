@@ -0,0 +1,382 @@
+#                      _              _     
+#                     | |            | |    
+#   ___ __ _  __ _ ___| |_ ___   ___ | |___ 
+#  / __/ _` |/ _` / __| __/ _ \ / _ \| / __|
+# | (_| (_| | (_| \__ \ || (_) | (_) | \__ \
+#  \___\__,_|\__,_|___/\__\___/ \___/|_|___/
+
+
+'''
+A Convergent Amino Acid Substitution identification 
+and analysis toolbox
+
+Author:         Fabio Barteri (fabio.barteri@upf.edu)
+
+Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
+                Xavier Farré (xfarrer@igtp.cat),
+                David de Juan (david.juan@upf.edu).
+
+MODULE NAME:    fastboot.py
+DESCRIPTION:    Bitset bootstrap kernel. The foreground and background of each resampled
+                trait (cycle) and the residues of each column are encoded as bit masks
+                over the species of the alignment, so the CAAS test for all the cycles
+                at one column is a handful of bitwise ANDs and popcounts.
+DEPENDENCIES:   alimport, pindex, cycles
+
+
+TABLE OF CONTENTS
+------------------------------------------
+
+pack_rows()                 packs a boolean (rows x species) matrix into
+                            (rows x words) uint64 bit masks.
+
+popcount()                  counts the bits of each bit mask.
+
+encoded_cycles              the resampled traits as fg/bg bit masks.
+
+encode_cycles()             encodes the resampled traits as fg/bg bit masks over
+                            the species of one alignment.
+
+encode_binary_cycles()      encode_cycles() for a binary cycles file.
+
+boot_column()               evaluates all the cycles on one alignment column.
+
+boot_block()                evaluates a block of cycles on all the alignment columns.
+
+boot_sequential()           Besag-Clifford sequential bootstrap (early stopping).
+
+caasboot_matrix()           vectorized caasboot() over a whole sliced alignment,
+                            in chunks of columns (optionally over blocks of
+                            cycles in parallel). Yields the lines.
+'''
+
+from modules.alimport import GAP, COLUMN_CHUNK, slice_object
+from modules.pindex import compile_traits
+from modules.cycles import binary_cycles, FG, BG, ABSENT
+
+import numpy as np
+import multiprocessing
+
+
+# FUNCTION pack_rows()
+# Packs a boolean (rows x species) matrix into (rows x words) uint64 bit masks
+
+def pack_rows(boolean_matrix):
+
+    packed = np.packbits(boolean_matrix, axis = 1, bitorder = "little")
+
+    padding = (-packed.shape[1]) % 8
+
+    if packed.shape[1] == 0:
+        padding = 8
+
+    if padding > 0:
+        packed = np.pad(packed, ((0, 0), (0, padding)))
+
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+# FUNCTION popcount()
+# Counts the bits of each bit mask (sum over the last axis)
+
+bits_in_byte = np.array([bin(x).count("1") for x in range(256)], dtype = np.int64)
+
+def popcount(masks):
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(masks).sum(axis = -1, dtype = np.int64)
+
+    as_bytes = masks.view(np.uint8)
+    return bits_in_byte[as_bytes].sum(axis = -1)
+
+
+# CLASS encoded_cycles
+# The resampled traits encoded as fg/bg bit masks over the species of one alignment.
+
+class encoded_cycles():
+    def __init__(self):
+        self.names = []
+        self.fg = None                  # (cycles x words) fg bit masks
+        self.bg = None                  # (cycles x words) bg bit masks
+        self.mfg = None                 # Missing fg species per cycle
+        self.mbg = None                 # Missing bg species per cycle
+
+    # A contiguous block of cycles (start to end)
+
+    def block(self, start, end):
+        z = encoded_cycles()
+        z.names = self.names[start:end]
+        z.fg = self.fg[start:end]
+        z.bg = self.bg[start:end]
+        z.mfg = self.mfg[start:end]
+        z.mbg = self.mbg[start:end]
+        return z
+
+
+# FUNCTION encode_cycles()
+# Encodes the resampled traits as fg/bg bit masks over the species of one alignment.
+# Species of a cycle that are not in the alignment are counted as missing.
+
+def encode_cycles(resampled_traits, species_index):
+
+    z = encoded_cycles()
+
+    if isinstance(resampled_traits, binary_cycles):
+        return encode_binary_cycles(z, resampled_traits, species_index)
+
+    index = compile_traits(resampled_traits)
+    numbers = [index.trait_number[x] for x in dict.fromkeys(resampled_traits.alltraits) if x in resampled_traits.trait2fg or x in resampled_traits.trait2bg]
+    z.names = [index.traits[x] for x in numbers]
+
+    # Species of the trait index in the alignment (columns of the masks) and missing
+
+    alignment_rows = index.alignment_rows(species_index)
+    present = alignment_rows >= 0
+
+    fg_matrix = np.zeros((len(z.names), len(species_index)), dtype = bool)
+    bg_matrix = np.zeros((len(z.names), len(species_index)), dtype = bool)
+
+    fg_matrix[:, alignment_rows[present]] = index.fg_mask[numbers][:, present]
+    bg_matrix[:, alignment_rows[present]] = index.bg_mask[numbers][:, present]
+
+    z.mfg = np.count_nonzero(index.fg_mask[numbers][:, ~present], axis = 1)
+    z.mbg = np.count_nonzero(index.bg_mask[numbers][:, ~present], axis = 1)
+
+    z.fg = pack_rows(fg_matrix)
+    z.bg = pack_rows(bg_matrix)
+
+    return z
+
+
+# FUNCTION encode_binary_cycles()
+# encode_cycles() for a binary cycles file: the masks are taken straight from the (cycles x species) matrix.
+
+def encode_binary_cycles(z, resampled_traits, species_index):
+
+    matrix = resampled_traits.matrix
+
+    # Cycles with at least one species (as the trait dictionaries of the tab loader)
+
+    used = np.flatnonzero(np.any(matrix != ABSENT, axis = 1))
+    z.names = [resampled_traits.alltraits[x] for x in used]
+
+    if len(used) < matrix.shape[0]:
+        matrix = matrix[used]
+
+    alignment_rows = np.array([species_index.get(x, -1) for x in resampled_traits.species], dtype = np.int64)
+    present = alignment_rows >= 0
+
+    fg_matrix = np.zeros((len(z.names), len(species_index)), dtype = bool)
+    bg_matrix = np.zeros((len(z.names), len(species_index)), dtype = bool)
+
+    fg_matrix[:, alignment_rows[present]] = matrix[:, present] == FG
+    bg_matrix[:, alignment_rows[present]] = matrix[:, present] == BG
+
+    z.mfg = np.count_nonzero(matrix[:, ~present] == FG, axis = 1)
+    z.mbg = np.count_nonzero(matrix[:, ~present] == BG, axis = 1)
+
+    z.fg = pack_rows(fg_matrix)
+    z.bg = pack_rows(bg_matrix)
+
+    return z
+
+
+# FUNCTION boot_column()
+# Evaluates all the cycles on one alignment column. Returns a boolean array (one value per cycle):
+# True if the cycle returns an admitted CAAS after gaps and missing species filtering.
+
+def boot_column(column, cycles, maxgaps_fg, maxgaps_bg, maxgaps_all, maxmiss_fg, maxmiss_bg, maxmiss_all, admitted_patterns):
+
+    symbols = [x for x in np.unique(column) if x != GAP]
+
+    if len(symbols) == 0:
+        return np.zeros(len(cycles.names), dtype = bool)
+
+    # One species mask per amino acid, plus the gaps mask
+
+    aa_masks = pack_rows(np.stack([column == x for x in symbols]))
+    gap_mask = pack_rows((column == GAP)[np.newaxis, :])[0]
+
+    # Amino acids in fg and bg per cycle (cycles x amino acids)
+
+    fg_aas = np.any((cycles.fg[:, np.newaxis, :] & aa_masks[np.newaxis, :, :]) != 0, axis = 2)
+    bg_aas = np.any((cycles.bg[:, np.newaxis, :] & aa_masks[np.newaxis, :, :]) != 0, axis = 2)
+
+    nfg = np.count_nonzero(fg_aas, axis = 1)
+    nbg = np.count_nonzero(bg_aas, axis = 1)
+
+    # The CAAS test: both groups have amino acids and they share none
+
+    out = (nfg > 0) & (nbg > 0) & ~np.any(fg_aas & bg_aas, axis = 1)
+
+    # Gaps and missing species filtering
+
+    if maxgaps_fg != "NO" or maxgaps_bg != "NO" or maxgaps_all != "NO":
+        gfg = popcount(cycles.fg & gap_mask)
+        gbg = popcount(cycles.bg & gap_mask)
+
+        if maxgaps_fg != "NO":
+            out &= gfg <= int(maxgaps_fg)
+        if maxgaps_bg != "NO":
+            out &= gbg <= int(maxgaps_bg)
+        if maxgaps_all != "NO":
+            out &= gfg + gbg <= int(maxgaps_all)
+
+    if maxmiss_fg != "NO":
+        out &= cycles.mfg <= int(maxmiss_fg)
+    if maxmiss_bg != "NO":
+        out &= cycles.mbg <= int(maxmiss_bg)
+    if maxmiss_all != "NO":
+        out &= cycles.mfg + cycles.mbg <= int(maxmiss_all)
+
+    # Pattern filtering (1: fg and bg converge, 2: fg converges, 3: bg converges, 4: none)
+
+    fg_single = nfg == 1
+    bg_single = nbg == 1
+
+    patterns = {
+        "1" : fg_single & bg_single,
+        "2" : fg_single & ~bg_single,
+        "3" : ~fg_single & bg_single,
+        "4" : ~fg_single & ~bg_single
+    }
+
+    for pattern in patterns.keys():
+        if pattern not in admitted_patterns:
+            out &= ~patterns[pattern]
+
+    return out
+
+
+# FUNCTION boot_block()
+# Runs boot_column() on all the columns of a sliced alignment for a block of cycles.
+# Returns, per column, the indexes of the positive cycles (within the block).
+
+def boot_block(sliced_object, cycles_block, filters):
+
+    return [np.flatnonzero(boot_column(sliced_object.matrix[:, i], cycles_block, *filters)) for i in range(len(sliced_object.positions))]
+
+
+# FUNCTION boot_sequential()
+# Besag-Clifford sequential bootstrap. The cycles are evaluated in growing blocks (100, 200, 400... up to 10000 cycles)
+# and a column stops as soon as it collects early_stop positive cycles: its empirical pvalue is early_stop / cycles used,
+# where the cycles used go up to the last positive one. The columns that never reach early_stop positives use all the cycles,
+# as in the full bootstrap. Returns, per column, the positive cycles and the number of cycles used.
+
+def boot_sequential(sliced_object, encoded, filters, early_stop, first_block = 100, max_block = 10000):
+
+    ncolumns = len(sliced_object.positions)
+    ncycles = len(encoded.names)
+
+    positives = [[] for i in range(ncolumns)]
+    counts = np.zeros(ncolumns, dtype = np.int64)
+    used = np.full(ncolumns, ncycles, dtype = np.int64)
+    active = list(range(ncolumns))
+
+    start = 0
+    size = first_block
+
+    while start < ncycles and len(active) > 0:
+
+        end = min(start + size, ncycles)
+        cycles_block = encoded.block(start, end)
+        still_active = []
+
+        for i in active:
+            block_positives = np.flatnonzero(boot_column(sliced_object.matrix[:, i], cycles_block, *filters)) + start
+
+            needed = early_stop - counts[i]
+
+            if len(block_positives) >= needed:
+                block_positives = block_positives[:needed]
+                used[i] = block_positives[-1] + 1
+            else:
+                still_active.append(i)
+
+            positives[i].append(block_positives)
+            counts[i] += len(block_positives)
+
+        active = still_active
+        start = end
+        size = min(size * 2, max_block)
+
+    positives = [np.concatenate(x) if len(x) > 0 else np.zeros(0, dtype = np.int64) for x in positives]
+
+    return positives, used
+
+
+# The settings of the cycle workers (set once per worker by init_block_worker())
+
+block_settings = {}
+
+def init_block_worker(sliced_object, encoded, filters):
+    block_settings["sliced_object"] = sliced_object
+    block_settings["encoded"] = encoded
+    block_settings["filters"] = filters
+
+def boot_block_worker(bounds):
+    start, end, first_column, last_column = bounds
+    sliced_object = block_settings["sliced_object"]
+
+    columns = slice_object(sliced_object.genename, sliced_object.species, sliced_object.matrix[:, first_column:last_column], sliced_object.positions[first_column:last_column])
+
+    return boot_block(columns, block_settings["encoded"].block(start, end), block_settings["filters"])
+
+
+# FUNCTION caasboot_matrix()
+# Vectorized caasboot(). Yields the same lines of caasboot(), one per column, in chunks of chunk_size columns:
+# the lines of a chunk are yielded before the next chunk is evaluated, so the positive cycles and the lines in memory
+# are bounded by the chunk, not by the length of the alignment.
+# With ncores > 1, the cycles are split in ncores contiguous blocks evaluated by separate processes (one pool for all
+# the chunks), and the positive cycles of each column are merged back in block order: the lines are the same of the
+# serial run. With early_stop, the columns are evaluated with boot_sequential() and the third field of each line is
+# the number of cycles actually used (serial).
+
+def caasboot_matrix(sliced_object, resampled_traits, maxgaps_fg, maxgaps_bg, maxgaps_all, maxmiss_fg, maxmiss_bg, maxmiss_all, cycles, admitted_patterns, ncores = 1, early_stop = None, chunk_size = COLUMN_CHUNK):
+
+    encoded = encode_cycles(resampled_traits, sliced_object.species_index)
+    filters = (maxgaps_fg, maxgaps_bg, maxgaps_all, maxmiss_fg, maxmiss_bg, maxmiss_all, admitted_patterns)
+
+    ncycles = len(encoded.names)
+    nblocks = max(1, min(ncores, ncycles))
+
+    pool = None
+
+    if early_stop == None and nblocks > 1:
+        edges = np.linspace(0, ncycles, nblocks + 1).astype(int)
+        bounds = list(zip(edges[:-1], edges[1:]))
+        pool = multiprocessing.Pool(nblocks, initializer = init_block_worker, initargs = (sliced_object, encoded, filters))
+
+    try:
+        for first_column, chunk in sliced_object.chunks(chunk_size):
+
+            used = np.full(len(chunk.positions), cycles, dtype = np.int64)
+
+            if early_stop != None:
+                positives, stopped = boot_sequential(chunk, encoded, filters, early_stop)
+                used[stopped < ncycles] = stopped[stopped < ncycles]
+
+            elif pool == None:
+                positives = boot_block(chunk, encoded, filters)
+
+            else:
+                last_column = first_column + len(chunk.positions)
+                block_positives = pool.map(boot_block_worker, [(start, end, first_column, last_column) for start, end in bounds], chunksize = 1)
+
+                positives = [np.concatenate([block[i] + start for block, (start, end) in zip(block_positives, bounds)]) for i in range(len(chunk.positions))]
+
+            for i, position in enumerate(chunk.positions):
+
+                position_name = chunk.genename + "@" + str(position)
+                positive_cycles = [encoded.names[x] for x in positives[i]]
+                count = str(len(positive_cycles))
+
+                traitline = ",".join(positive_cycles)
+                empval = str(int(count)/int(used[i]))
+
+                yield "\t".join([position_name, count, str(used[i]), empval, traitline])
+
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
@@ -0,0 +1,281 @@
+#                      _              _     
+#                     | |            | |    
+#   ___ __ _  __ _ ___| |_ ___   ___ | |___ 
+#  / __/ _` |/ _` / __| __/ _ \ / _ \| / __|
+# | (_| (_| | (_| \__ \ || (_) | (_) | \__ \
+#  \___\__,_|\__,_|___/\__\___/ \___/|_|___/
+
+
+'''
+A Convergent Amino Acid Substitution identification 
+and analysis toolbox
+
+Author:         Fabio Barteri (fabio.barteri@upf.edu)
+
+Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
+                Xavier Farré (xfarrer@igtp.cat),
+                David de Juan (david.juan@upf.edu).
+
+MODULE NAME:    fastcaas.py
+DESCRIPTION:    Vectorized CAAS identification. Scans all the columns of a sliced
+                alignment matrix at once and returns the same rows of caas_id.fetch_caas().
+DEPENDENCIES:   alimport, hyper, pindex
+
+
+TABLE OF CONTENTS
+------------------------------------------
+
+symbol_bits()               the bit of every amino acid of the alignment matrix
+                            (one bit per amino acid, gaps are 0).
+
+trait_rows()                foreground and background rows of a trait in the
+                            alignment matrix, plus the missing species.
+
+scan_trait()                runs the CAAS test on all the columns for one trait.
+
+fetch_caas_matrix()         vectorized fetch_caas() over a whole sliced alignment
+                            (in chunks of columns).
+
+scan_chunk()                runs all the traits on a chunk of columns and prints
+                            its rows.
+'''
+
+from modules.alimport import GAP, COLUMN_CHUNK
+from modules.hyper import calcpval_frequencies
+from modules.pindex import compile_traits
+from modules import profiler
+
+import numpy as np
+
+
+# FUNCTION symbol_bits()
+# Encodes every residue of the alignment matrix as a bit (one bit per amino acid, gaps are 0).
+# Returns the sorted list of symbols and the bit lookup table (bits = lookup[matrix]), or None if there are more than 64 symbols.
+
+def symbol_bits(matrix):
+
+    symbols = [x for x in np.flatnonzero(np.bincount(matrix.ravel(order = "A"), minlength = 256)) if x != GAP]
+
+    if len(symbols) > 64:
+        return None
+
+    lookup = np.zeros(256, dtype = np.uint64)
+
+    for i, x in enumerate(symbols):
+        lookup[x] = np.uint64(1) << np.uint64(i)
+
+    return symbols, lookup
+
+
+# FUNCTION trait_rows()
+# Foreground and background rows of a trait in the alignment matrix, plus the missing species.
+# The rows come from the compiled trait index (see pindex.compile_traits()) and the alignment rows of its species.
+
+def trait_rows(index, trait, alignment_rows):
+
+    class trait_in_alignment():
+        def __init__(self):
+            self.fg_rows = []
+            self.bg_rows = []
+            self.fg_missing = []
+            self.bg_missing = []
+
+    z = trait_in_alignment()
+
+    if trait not in index.trait_number:
+        return z
+
+    fg = alignment_rows[index.fg_ids[trait]]
+    bg = alignment_rows[index.bg_ids[trait]]
+
+    z.fg_rows = fg[fg >= 0]
+    z.bg_rows = bg[bg >= 0]
+    z.fg_missing = [index.species[x] for x in index.fg_ids[trait][fg < 0]]
+    z.bg_missing = [index.species[x] for x in index.bg_ids[trait][bg < 0]]
+
+    return z
+
+
+# FUNCTION scan_trait()
+# Runs the CAAS test on all the columns for one trait. Returns the
+# fg and bg amino acid bitsets, the gap counts and the pattern per column.
+
+def scan_trait(bits, gaps, rows):
+
+    class scanned_trait():
+        def __init__(self):
+            self.fg_bits = None
+            self.bg_bits = None
+            self.gfg = None
+            self.gbg = None
+            self.caas = None
+            self.pattern = None
+
+    z = scanned_trait()
+    ncolumns = bits.shape[1]
+
+    if len(rows.fg_rows) > 0:
+        z.fg_bits = np.bitwise_or.reduce(bits[rows.fg_rows], axis = 0)
+        z.gfg = np.count_nonzero(gaps[rows.fg_rows], axis = 0)
+    else:
+        z.fg_bits = np.zeros(ncolumns, dtype = np.uint64)
+        z.gfg = np.zeros(ncolumns, dtype = np.int64)
+
+    if len(rows.bg_rows) > 0:
+        z.bg_bits = np.bitwise_or.reduce(bits[rows.bg_rows], axis = 0)
+        z.gbg = np.count_nonzero(gaps[rows.bg_rows], axis = 0)
+    else:
+        z.bg_bits = np.zeros(ncolumns, dtype = np.uint64)
+        z.gbg = np.zeros(ncolumns, dtype = np.int64)
+
+    # The CAAS test: both groups have at least one amino acid and they share none
+    z.caas = (z.fg_bits != 0) & (z.bg_bits != 0) & ((z.fg_bits & z.bg_bits) == 0)
+
+    # The pattern: one single amino acid is a bitset with one single bit
+    fg_single = (z.fg_bits & (z.fg_bits - np.uint64(1))) == 0
+    bg_single = (z.bg_bits & (z.bg_bits - np.uint64(1))) == 0
+
+    z.pattern = np.full(ncolumns, "4")
+    z.pattern[bg_single] = "3"
+    z.pattern[fg_single] = "2"
+    z.pattern[fg_single & bg_single] = "1"
+
+    return z
+
+
+# FUNCTION fetch_caas_matrix()
+# Vectorized fetch_caas() over a whole sliced alignment. Prints the same rows of fetch_caas(), in the same position order.
+# The columns are scanned in chunks of chunk_size columns and the rows of each chunk are written before the next one.
+# Returns False if the alignment can't be encoded (more than 64 symbols): in that case use fetch_caas().
+
+def fetch_caas_matrix(sliced_object, multiconfig, list_of_traits, output_writer, maxgaps_fg, maxgaps_bg, maxgaps_all, maxmiss_fg, maxmiss_bg, maxmiss_all, admitted_patterns = ["1","2","3"], chunk_size = COLUMN_CHUNK):
+
+    encoded = symbol_bits(sliced_object.matrix)
+
+    if encoded == None:
+        return False
+
+    symbols, lookup = encoded
+
+    index = compile_traits(multiconfig)
+    alignment_rows = index.alignment_rows(sliced_object.species_index)
+
+    traits = list(dict.fromkeys(list_of_traits))
+    rows = [trait_rows(index, trait, alignment_rows) for trait in traits]
+
+    for start, chunk in sliced_object.chunks(chunk_size):
+        scan_chunk(chunk, traits, rows, symbols, lookup, output_writer, maxgaps_fg, maxgaps_bg, maxgaps_all, maxmiss_fg, maxmiss_bg, maxmiss_all, admitted_patterns)
+
+    return True
+
+
+# FUNCTION scan_chunk()
+# Runs the CAAS test of all the traits on a chunk of columns and prints the rows of the chunk (position by position)
+
+def scan_chunk(sliced_object, traits, trait_rows_list, symbols, lookup, output_writer, maxgaps_fg, maxgaps_bg, maxgaps_all, maxmiss_fg, maxmiss_bg, maxmiss_all, admitted_patterns):
+
+    bits = lookup[sliced_object.matrix]
+    gaps = sliced_object.matrix == GAP
+
+    # Scan the traits
+
+    hits = []
+
+    for trait_number, (trait, rows) in enumerate(zip(traits, trait_rows_list)):
+
+        scan = scan_trait(bits, gaps, rows)
+
+        mfg = len(rows.fg_missing)
+        mbg = len(rows.bg_missing)
+
+        # Gaps and missing species filtering
+
+        passed = scan.caas.copy()
+
+        if maxgaps_fg != "NO":
+            passed &= scan.gfg <= int(maxgaps_fg)
+        if maxgaps_bg != "NO":
+            passed &= scan.gbg <= int(maxgaps_bg)
+        if maxgaps_all != "NO":
+            passed &= scan.gfg + scan.gbg <= int(maxgaps_all)
+
+        if maxmiss_fg != "NO" and mfg > int(maxmiss_fg):
+            passed[:] = False
+        if maxmiss_bg != "NO" and mbg > int(maxmiss_bg):
+            passed[:] = False
+        if maxmiss_all != "NO" and mfg + mbg > int(maxmiss_all):
+            passed[:] = False
+
+        # Columns that can't be a CAAS for this trait (see runslice.trait_prefilter())
+
+        if sliced_object.trait_columns != None and trait in sliced_object.trait_columns:
+            passed &= sliced_object.trait_columns[trait]
+
+        # Pattern filtering
+
+        for pattern in ("1", "2", "3", "4"):
+            if pattern not in admitted_patterns:
+                passed &= scan.pattern != pattern
+
+        for column in np.flatnonzero(passed):
+            hits.append((column, trait_number, trait, rows, scan, mfg, mbg))
+
+    # Print the output (position by position)
+
+    hits.sort(key = lambda x : (x[0], x[1]))
+
+    # The symbol frequencies of a column are counted once, whatever the number of traits with a CAAS in it
+    column_frequencies = {}
+
+    for column, trait_number, traitname, rows, scan, mfg, mbg in hits:
+
+        position = str(sliced_object.positions[column])
+        residues = sliced_object.matrix[:, column]
+
+        fg_tag = "".join([chr(x) for i, x in enumerate(symbols) if int(scan.fg_bits[column]) >> i & 1])
+        bg_tag = "".join([chr(x) for i, x in enumerate(symbols) if int(scan.bg_bits[column]) >> i & 1])
+        change = fg_tag + "/" + bg_tag
+
+        fg_ungapped = [sliced_object.species[x] for x in rows.fg_rows if residues[x] != GAP]
+        bg_ungapped = [sliced_object.species[x] for x in rows.bg_rows if residues[x] != GAP]
+
+        fg_ungapped.sort()
+        bg_ungapped.sort()
+
+        missings = "-"
+
+        if mfg + mbg > 0:
+            missings = ",".join(rows.fg_missing + rows.bg_missing)
+
+        # The pvalue (symbol frequencies over all the species in the alignment)
+
+        if column not in column_frequencies:
+            ungapped_residues = residues[residues != GAP]
+            values, counts = np.unique(ungapped_residues, return_counts = True)
+            column_frequencies[column] = dict(zip([chr(x) for x in values], [int(x) for x in counts]))
+
+        frequencies = column_frequencies[column]
+
+        pv = calcpval_frequencies(frequencies, sliced_object.genename, position, len(fg_ungapped), len(bg_ungapped))
+        pvalue_string = str(pv)
+
+        print("CAAS found in alignment", sliced_object.genename, "on position", position, "with pvalue", pvalue_string)
+        profiler.count("caas_pattern" + scan.pattern[column])
+
+        output_writer.write(  "\t".join(
+            [sliced_object.genename,
+                traitname,
+                position,
+                change,
+                pvalue_string,
+                "pattern" + scan.pattern[column],
+                str(len(fg_ungapped)),
+                str(len(bg_ungapped)),
+                str(scan.gfg[column]),
+                str(scan.gbg[column]),
+                str(mfg),
+                str(mbg),
+                ",".join(fg_ungapped),
+                ",".join(bg_ungapped),
+                missings]
+        ))
@@ -19,6 +19,15 @@ Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
 MODULE NAME:    hyper.py
 DESCRIPTION:    Pvalue assignment to CAAS prediction based on hypergeometric probability function.
 DEPENDENCIES:   TBD
+
+The hypergeometric probabilities depend on small integers (species counts) that repeat
+across positions and genes. They are memoized at two levels, both with an LRU bound:
+
+hypergeom_pmf()             pmf values, keyed on (M, n, N, k).
+pvalue_signature()          whole position pvalues, keyed on the sorted symbol
+                            frequencies plus the fg and bg sizes.
+
+pvalue_cache_info() returns the hits and misses of both caches.
 '''
 
 
@@ -27,6 +36,14 @@ import functools
 from scipy import stats as ss
 import glob
 
+from modules import profiler
+
+
+# Bounds of the pvalue caches (number of entries)
+
+PMF_CACHE_SIZE = 65536
+PVALUE_CACHE_SIZE = 65536
+
 
 # FUNCTION count_symbols() - Counts the symbols (AAs) 
 def count_symbols(list1, list2):
@@ -68,18 +85,37 @@ def pstate(iterable, freq_dictionary, set_size, contrast_size, mode = "independe
     if N > Mn:
         p = 0
     else:
-        l = ss.hypergeom(Mn, n, N)
-        p = l.pmf(k)
+        p = hypergeom_pmf(Mn, n, N, k)
 
     return p
 
+# FUNCTION hypergeom_pmf() - Memoized hypergeometric probability mass function
+
+@functools.lru_cache(maxsize = PMF_CACHE_SIZE)
+def hypergeom_pmf(M, n, N, k):
+    return ss.hypergeom(M, n, N).pmf(k)
+
 def sstate(combination, freq_dictionary, fg_size, bg_size):
     f = pstate(list(combination[0]), freq_dictionary, fg_size, bg_size)
     b = pstate(list(combination[1]), freq_dictionary, bg_size, fg_size, mode="dependent")
     return f * b
 
-# FUNCTION calcpval_random() - fetches a pvalue from a line, given foreground and background sizes
-def calcpval_random(line_dictionary, genename, fg_size, bg_size):
+# FUNCTION calcpval_frequencies() - fetches a pvalue from the symbol frequencies of a position, given foreground and background sizes.
+# The pvalue does not depend on which amino acids are there, only on their frequencies: positions with the same
+# frequencies signature share the same (cached) pvalue.
+def calcpval_frequencies(freq_dictionary, genename, position, fg_size, bg_size):
+
+    signature = tuple(sorted(freq_dictionary.values()))
+
+    if profiler.enabled:
+        with profiler.stage("pvalue"):
+            return pvalue_signature(signature, fg_size, bg_size)
+
+    return pvalue_signature(signature, fg_size, bg_size)
+
+# FUNCTION pvalue_signature() - the memoized pvalue of a frequencies signature
+@functools.lru_cache(maxsize = PVALUE_CACHE_SIZE)
+def pvalue_signature(signature, fg_size, bg_size):
 
     class lstats():
         def __init__(self):
@@ -97,8 +133,6 @@ def calcpval_random(line_dictionary, genename, fg_size, bg_size):
 
             self.pvalue = 0
 
-            self.out_tuple = ()
-
         def combine(self):
             # Correction for even fg/bg comparisons
 
@@ -138,25 +172,41 @@ def calcpval_random(line_dictionary, genename, fg_size, bg_size):
             else:
                 self.pvalue = p_comb
             
-            self.out_tuple = (genename + "@" + str(self.p), self.pvalue)
-
     z = lstats()
 
+    # Load the z object (the amino acids are replaced by placeholder one-character symbols)
+
+    z.s = [chr(0x100 + x) for x in range(len(signature))]
+    z.sfreq = dict(zip(z.s, signature))
+    z.combine()
+    z.dostat()
+
+    return z.pvalue
+
+# FUNCTION calcpval_random() - fetches a pvalue from a line, given foreground and background sizes
+def calcpval_random(line_dictionary, genename, fg_size, bg_size):
+
     symbols = list(map(lambda x : x.split("@")[0], line_dictionary.values()))
-    z.p = list(map(lambda x : x.split("@")[1], line_dictionary.values()))[0]
+    position = list(map(lambda x : x.split("@")[1], line_dictionary.values()))[0]
     
     accepted_symbols = []
     for x in symbols:
         if x != "-":
             accepted_symbols.append(x) # Clean the gaps...
-    # Load the z object
 
-    z.s = set(accepted_symbols)
-    z.sfreq = count_symbols(z.s, accepted_symbols)
-    z.combine()
-    z.dostat()
+    return calcpval_frequencies(count_symbols(set(accepted_symbols), accepted_symbols), genename, position, fg_size, bg_size)
 
-    return z.pvalue
+# FUNCTION pvalue_cache_info() - hits and misses of the pvalue caches
+
+def pvalue_cache_info():
+
+    out = {}
+
+    for name, cached in (("pmf", hypergeom_pmf), ("position", pvalue_signature)):
+        info = cached.cache_info()
+        out[name] = {"hits" : info.hits, "misses" : info.misses, "size" : info.currsize, "maxsize" : info.maxsize}
+
+    return out
 
 ### FUNCTION genepval() - iterates the pvalue calculation over a whole gene
 
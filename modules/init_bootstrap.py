@@ -19,28 +19,37 @@ Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
 
 MODULE NAME: INIT BOOTSTRAP
 DESCRIPTION: Initialises the bootstrap through different strategy (random, phylogeny and permulations)
-DEPENDENCIES: none
+DEPENDENCIES: cycles
 CALLED BY: ct
 '''
 
 
-import random
-import os
-import sys
-import dendropy
+import numpy as np
 
+from modules.cycles import cycles_writer, is_binary_cycles, load_cycles
 
-# FUNCTION readtree(). Reads a tree and releases an object with some information (list of species, patristic distances matrix, bins)
 
-def readtree(tree_file, tree_schema = "newick"):
+# The cycles are drawn in blocks of CYCLES_BLOCK cycles. Every block has its own random stream, spawned from the seed by
+# block number: the same seed returns the same cycles whatever the number of shards the resampling is split into.
 
+CYCLES_BLOCK = 1000
+
+
+# FUNCTION readtree(). Reads a tree and releases an object with some information (list of species, tree structure,
+# patristic distances matrix, distances from the farthest species). The tree is traversed once: the nodes are indexed in
+# preorder (parents before children) and the patristic distances are only calculated if requested (distances = True),
+# as a numpy matrix over the species (depth of two species minus twice the depth of their last common ancestor).
+
+def readtree(tree_file, tree_schema = "newick", distances = True):
+
+    import dendropy         # Only needed to read trees (not to revive the resampled traits)
 
     class topology():
 
         def __init__(self):
             self.treename = ""
             self.species_list = []
-            self.pdd = {}
+            self.pdd = None                 # (species x species) patristic distances matrix
             self.farthest = ""
             self.maxd = 0
 
@@ -49,62 +58,381 @@ def readtree(tree_file, tree_schema = "newick"):
             self.binlist = []
             self.index_dictionary = {}
 
+            self.parent = None              # Parent node of each node (preorder, -1 for the root)
+            self.edge_length = None         # Length of the edge above each node
+            self.node_depth = None          # Distance of each node from the root
+            self.leaf_nodes = None          # Node of each species in species_list
+
     z = topology()
 
-    # FUNCTION create_tag()
-    # Two species into a single tag
+    # Step 1: read the tree and index the nodes (preorder)
 
-    def create_tag(species1, species2):
-        t = [species1, species2]
-        t.sort()
+    tree = dendropy.Tree.get(
+        path=tree_file,
+        schema=tree_schema)
 
-        return "@".join(t)
+    nodes = list(tree.preorder_node_iter())
+    node_index = {id(x) : i for i, x in enumerate(nodes)}
 
+    z.parent = np.array([node_index[id(x.parent_node)] if x.parent_node != None else -1 for x in nodes], dtype = np.int64)
+    z.edge_length = np.array([x.edge.length if x.edge.length != None else 0.0 for x in nodes], dtype = np.float64)
+    z.node_depth = np.zeros(len(nodes), dtype = np.float64)
 
-    # Step 1: fetch the distances
-    z.pdd = {}
+    for i in range(1, len(nodes)):
+        z.node_depth[i] = z.node_depth[z.parent[i]] + z.edge_length[i]
 
-    tree = dendropy.Tree.get(
-        path=tree_file,
-        schema=tree_schema)
-    pdc = tree.phylogenetic_distance_matrix()
+    leaves = [i for i, x in enumerate(nodes) if x.is_leaf() and x.taxon != None]
 
-    for i, t1 in enumerate(tree.taxon_namespace[:-1]):
-        for t2 in tree.taxon_namespace[i+1:]:
-            thecouple = [t1.label.replace(" ", "_"), t2.label.replace(" ", "_")]
-            z.species_list.append(t1.label.replace(" ", "_"))
-            z.species_list.append(t2.label.replace(" ", "_"))
-            thecouple.sort()
-            key = "@".join(thecouple)
-            z.pdd[key] = pdc(t1, t2)
+    z.leaf_nodes = np.array(leaves, dtype = np.int64)
+    z.species_list = [nodes[i].taxon.label.replace(" ", "_") for i in leaves]
+    z.species_to_index = {x : i for i, x in enumerate(z.species_list)}
 
-    z.species_list = list(set(z.species_list))      # Eliminate duplicates
+    # The random mode only needs the species
 
-    # Step 2: fetch the farthest species
+    if distances == False:
+        return z
 
-    z.pdd = dict(sorted(z.pdd.items(), key=lambda item: item[1]))
-    z.farthest = list(z.pdd.items())[-1][0].split("@")[0]
-    z.maxd = float(list(z.pdd.items())[-1][1])
+    # Step 2: the patristic distances. Every pair of species is set once, at their last common ancestor
+    # (postorder: the species below each node are the ones of its children).
 
-    # Step 3: the distance from fartest (dff) dictionary
+    nspecies = len(z.species_list)
+    species_depth = z.node_depth[z.leaf_nodes]
+    z.pdd = np.zeros((nspecies, nspecies), dtype = np.float64)
 
-    z.dff[z.farthest] = 0
+    below = {}
 
-    for s in z.species_list:
-        if s != z.farthest:
-            t = create_tag(s, z.farthest)
-            d = z.pdd[t]
-            z.dff[s] = d
+    for i, x in zip(z.leaf_nodes, range(nspecies)):
+        below[i] = np.array([x], dtype = np.int64)
 
-    # Sort the dictionary 
-    z.dff = dict(sorted(z.dff.items(), key=lambda item: item[1]))
+    for i in range(len(nodes) - 1, -1, -1):
+
+        children = [node_index[id(x)] for x in nodes[i].child_nodes()]
+        groups = [below.pop(x) for x in children if x in below]
+
+        for a in range(len(groups)):
+            for b in range(a + 1, len(groups)):
+                d = species_depth[groups[a]][:, np.newaxis] + species_depth[groups[b]][np.newaxis, :] - 2 * z.node_depth[i]
+                z.pdd[np.ix_(groups[a], groups[b])] = d
+                z.pdd[np.ix_(groups[b], groups[a])] = d.T
+
+        if len(groups) > 0:
+            below[i] = np.concatenate(groups + ([below.pop(i)] if i in below else []))
+
+    # Step 3: fetch the farthest species (of the farthest pair, the first one in alphabetical order)
+
+    upper = np.triu(z.pdd, k = 1)
+    z.maxd = float(upper.max()) if nspecies > 1 else 0.0
+    pairs = np.argwhere(upper == z.maxd)
+    a, b = pairs[-1] if nspecies > 1 else (0, 0)
+    z.farthest = min(z.species_list[a], z.species_list[b])
+
+    # Step 4: the distance from fartest (dff) dictionary, sorted by distance
+
+    f = z.species_to_index[z.farthest]
+    order = np.argsort(z.pdd[f], kind = "stable")
+    z.dff = {z.species_list[x] : float(z.pdd[f, x]) for x in order}
 
     return z
 
 
+# FUNCTION cycle_blocks(). Lists the blocks of cycles of a shard (the shards are contiguous ranges of blocks).
+# Returns a list of (first cycle, number of cycles, random generator) tuples.
+
+def cycle_blocks(cycles, seed = None, shard_index = 0, shard_count = 1, block_size = CYCLES_BLOCK):
+
+    root = np.random.SeedSequence(seed)
+    nblocks = -(-cycles // block_size)
+
+    first = shard_index * nblocks // shard_count
+    last = (shard_index + 1) * nblocks // shard_count
+
+    blocks = []
+
+    for b in range(first, last):
+        stream = np.random.SeedSequence(root.entropy, spawn_key = (b,))
+        blocks.append((b * block_size, min(block_size, cycles - b * block_size), np.random.default_rng(stream)))
+
+    return blocks
+
+
+# FUNCTION block_chunks(). Splits the blocks of cycles in chunks of at most chunk_size cycles. Yields the size of each
+# chunk and the random generator of its block.
+
+def block_chunks(blocks, chunk_size):
+
+    for start, n, rng in blocks:
+        for offset in range(0, n, chunk_size):
+            yield min(chunk_size, n - offset), rng
+
+
+# FUNCTION draw_random_cycles(). Draws the random cycles in chunks. Each cycle is a random permutation of the species:
+# the first fg_len species are the foreground, the following bg_len the background. Yields the (cycles x fg_len) and
+# (cycles x bg_len) species indexes of each chunk.
+
+def draw_random_cycles(nspecies, fg_len, bg_len, blocks, chunk_size = CYCLES_BLOCK):
+
+    for n, rng in block_chunks(blocks, chunk_size):
+
+        order = rng.permuted(np.tile(np.arange(nspecies, dtype = np.int32), (n, 1)), axis = 1)
+
+        yield order[:, :fg_len], order[:, fg_len:fg_len + bg_len]
+
+
+# FUNCTION distance_bins(). Splits the species of a tree (read with distances) in nbins intervals of equal width of their
+# distance from the farthest species. Sets the bin edges (binlist) and the species of each bin (index_dictionary) of the
+# tree object and returns a dictionary species -> bin.
+
+def distance_bins(t, nbins):
+
+    distances = np.array([t.dff[x] for x in t.species_list], dtype = np.float64)
+    t.binlist = list(np.linspace(0.0, distances.max(), nbins + 1))
+
+    # The last bin is closed on the right (it includes the farthest species from the farthest)
+    bins = np.minimum(np.searchsorted(t.binlist, distances, side = "right") - 1, nbins - 1)
+
+    t.index_dictionary = {}
+
+    for x, b in zip(t.species_list, bins):
+        t.index_dictionary.setdefault(int(b), []).append(x)
+
+    return dict(zip(t.species_list, [int(x) for x in bins]))
+
+
+# FUNCTION group_samples(). Counts how many species of each group the template foreground and background need.
+# Returns the list of groups with the species indexes of each group and the fg and bg counts.
+# Prints an error and exits if a group has fewer species than the template asks for (no resampling is possible).
+
+def group_samples(species, s2g, template_fg, template_bg, group_label = "group"):
+
+    members = {}
+
+    for i, x in enumerate(species):
+        members.setdefault(s2g[x], []).append(i)
+
+    fg_counts = {}
+    bg_counts = {}
+
+    for x in template_fg:
+        fg_counts[s2g[x]] = fg_counts.get(s2g[x], 0) + 1
+    for x in template_bg:
+        bg_counts[s2g[x]] = bg_counts.get(s2g[x], 0) + 1
+
+    groups = sorted(set(fg_counts) | set(bg_counts), key = str)
+
+    for g in groups:
+        needed = fg_counts.get(g, 0) + bg_counts.get(g, 0)
+        if needed > len(members[g]):
+            print("ERROR: the template needs", needed, "species from", group_label, str(g) + ", which has only", len(members[g]), "species. No resampling is possible.")
+            exit()
+
+    return ([np.array(members[g], dtype = np.int32) for g in groups],
+            [fg_counts.get(g, 0) for g in groups],
+            [bg_counts.get(g, 0) for g in groups])
+
+
+# FUNCTION draw_group_cycles(). Draws the group-restricted cycles in chunks. In each cycle, every group is shuffled once:
+# its first fg_count species go to the foreground, the following bg_count to the background (no replacement, no rejection).
+# Yields the (cycles x fg size) and (cycles x bg size) species indexes of each chunk (sorted per cycle).
+
+def draw_group_cycles(members, fg_counts, bg_counts, blocks, chunk_size = CYCLES_BLOCK):
+
+    for n, rng in block_chunks(blocks, chunk_size):
+
+        fg_parts = []
+        bg_parts = []
+
+        for group, k, l in zip(members, fg_counts, bg_counts):
+            order = rng.permuted(np.tile(group, (n, 1)), axis = 1)
+            fg_parts.append(order[:, :k])
+            bg_parts.append(order[:, k:k + l])
+
+        yield np.sort(np.concatenate(fg_parts, axis = 1), axis = 1), np.sort(np.concatenate(bg_parts, axis = 1), axis = 1)
+
+
+# FUNCTION read_template(). Reads the foreground and background species of a template (trait config) file
+
+def read_template(template):
+
+    fg = []
+    bg = []
+
+    try:
+        with open(template) as tcf_handle:
+            tcf = tcf_handle.read().splitlines()
+    except:
+        print("ERROR: couldn't read template file. Input given:", template)
+        exit()
+
+    for l in tcf:
+        c = l.split("\t")
+        if len(c) > 1 and c[1] == "1":
+            fg.append(c[0])
+        elif len(c) > 1 and c[1] == "0":
+            bg.append(c[0])
+
+    return fg, bg
+
+
+# FUNCTION read_trait_values(). Reads the phenotype values file (species <tab> value, extra columns are ignored).
+# Returns a dictionary species -> value.
+
+def read_trait_values(phenotype_values_file):
+
+    values = {}
+
+    try:
+        with open(phenotype_values_file) as pv_handle:
+            pv = pv_handle.read().splitlines()
+    except:
+        print("ERROR: couldn't read trait values file. Input given:", phenotype_values_file)
+        exit()
+
+    for l in pv:
+        c = l.split("\t")
+        try:
+            values[c[0]] = float(c[1])
+        except:
+            pass
+
+    return values
+
+
+# FUNCTION simulate_bm(). Simulates a brownian motion on the tree for n cycles at once. The nodes are in preorder, so
+# they are visited by depth level (number of edges from the root): every node of a level takes the value of its parent
+# plus a normal step with variance equal to the edge length. Returns the (cycles x species) values of the species nodes.
+# The rate and the root value are not needed: the permulations only use the ranks of the simulated values.
+
+def simulate_bm(parent, edge_length, levels, species_nodes, n, rng):
+
+    x = rng.standard_normal((len(parent), n))
+    x *= np.sqrt(edge_length)[:, np.newaxis]
+    x[0] = 0.0
+
+    for level in levels:
+        x[level] += x[parent[level]]
+
+    return x[species_nodes].T
+
+
+# FUNCTION draw_bm_cycles(). Draws the permulation cycles in chunks. Each cycle simulates a brownian motion on the tree and
+# gives the observed values to the species by rank (the species with the lowest simulated value takes the lowest observed
+# value, and so on). The species with a foreground value can be picked for the foreground, the ones with a background value
+# for the background. The selection strategy picks them at random ("random"), the foreground from the highest values and
+# the background from the lowest ("inner") or the other way around ("edges"). Yields the (cycles x fg_len) and
+# (cycles x bg_len) species indexes of each chunk (-1 pads the cycles with too few candidates).
+
+def draw_bm_cycles(t, species, values, fg_len, bg_len, blocks, strategy = "random", fg_values = [], bg_values = [], chunk_size = 1000):
+
+    nspecies = len(species)
+
+    # The tree (preorder arrays of readtree()) and its depth levels
+
+    level = np.zeros(len(t.parent), dtype = np.int64)
+    for i in range(1, len(t.parent)):
+        level[i] = level[t.parent[i]] + 1
+
+    levels = [np.flatnonzero(level == i) for i in range(1, int(level.max()) + 1)] if len(level) > 1 else []
+    species_nodes = t.leaf_nodes[[t.species_to_index[x] for x in species]]
+
+    # The observed values (sorted) and their dense rank (ties share the same rank)
+
+    sorted_values = np.sort(np.array([values[x] for x in species], dtype = np.float64))
+    value_rank = np.unique(sorted_values, return_inverse = True)[1].reshape(-1)
+
+    fg_value_set = np.isin(sorted_values, np.array(fg_values, dtype = np.float64))
+    bg_value_set = np.isin(sorted_values, np.array(bg_values, dtype = np.float64))
+
+    for n, rng in block_chunks(blocks, chunk_size):
+
+        simulated = simulate_bm(t.parent, t.edge_length, levels, species_nodes, n, rng)
+        rank = np.argsort(np.argsort(simulated, axis = 1), axis = 1)
+
+        fg_pool = fg_value_set[rank]
+        bg_pool = bg_value_set[rank]
+
+        # The selection keys (the lowest keys are picked first). Ranks break the ties between equal values.
+
+        ascending = rank.astype(np.float64)
+        descending = -value_rank[rank].astype(np.float64) * nspecies + rank
+
+        if strategy == "inner":
+            fg_key, bg_key = descending, ascending
+        elif strategy == "edges":
+            fg_key, bg_key = ascending, descending
+        else:
+            fg_key, bg_key = rng.random((n, nspecies)), rng.random((n, nspecies))
+
+        fg = pick_species(fg_key, fg_pool, fg_len)
+
+        # A species picked for the foreground is not a background candidate (possible with tied values)
+
+        picked = np.zeros((n, nspecies + 1), dtype = bool)
+        picked[np.arange(n)[:, np.newaxis], fg] = True
+        bg_pool &= ~picked[:, :-1]
+
+        bg = pick_species(bg_key, bg_pool, bg_len)
+
+        yield fg, bg
+
+
+# FUNCTION pick_species(). Picks, per cycle, the size candidates with the lowest keys. Pads with -1 if there are
+# fewer candidates than the size.
+
+def pick_species(key, pool, size):
+
+    key = np.where(pool, key, np.inf)
+    picked = np.argsort(key, axis = 1, kind = "stable")[:, :size]
+
+    available = np.count_nonzero(pool, axis = 1)[:, np.newaxis]
+    picked[np.arange(size)[np.newaxis, :] >= available] = -1
+
+    return picked
+
+
+# FUNCTION write_cycles(). Writes the cycles, chunk by chunk, to the text file and, optionally, to a binary cycles file.
+# Updates the trait dictionaries of the resampled traits object.
+
+def write_cycles(z, species, chunks, simtraits_outfile, binary_outfile = "none"):
+
+    species_array = np.array(species, dtype = object)
+
+    binary_writer = None
+
+    if binary_outfile != "none":
+        binary_writer = cycles_writer(binary_outfile, species, z.alltraits)
+
+    done = 0
+
+    with open(simtraits_outfile, "w") as o:
+
+        for fg, bg in chunks:
+
+            names = z.alltraits[done:done + fg.shape[0]]
+
+            if (fg < 0).any() or (bg < 0).any():
+                fg_lists = [list(species_array[x[x >= 0]]) for x in fg]
+                bg_lists = [list(species_array[x[x >= 0]]) for x in bg]
+            else:
+                fg_lists = [list(x) for x in species_array[fg]]
+                bg_lists = [list(x) for x in species_array[bg]]
+
+            o.write("".join([x + "\t" + ",".join(f) + "\t" + ",".join(b) + "\n" for x, f, b in zip(names, fg_lists, bg_lists)]))
+
+            z.trait2fg.update(zip(names, fg_lists))
+            z.trait2bg.update(zip(names, bg_lists))
+
+            if binary_writer != None:
+                binary_writer.write_groups(fg, bg)
+
+            done += fg.shape[0]
+
+    if binary_writer != None:
+        binary_writer.close()
+
+
 # FUNCTION simtrait() Resample trait function
 
-def simtrait(fg_len, bg_len, template, tree_file, mode, groupfile, phenotype_values_file, cycles, simtraits_outfile, permulation_selection_strategy = "random"):
+def simtrait(fg_len, bg_len, template, tree_file, mode, groupfile, phenotype_values_file, cycles, simtraits_outfile, permulation_selection_strategy = "random", seed = None, binary_outfile = "none", pd_bins = 10, shard_index = 0, shard_count = 1):
     
     # Class multicfg
     class multicfg():
@@ -145,166 +473,97 @@ def simtrait(fg_len, bg_len, template, tree_file, mode, groupfile, phenotype_val
 
     z = multicfg()
 
-    # Step 1: import the species 
+    # Step 1: import the species (and the patristic distances, if the mode needs them)
 
-    t = readtree(tree_file)
+    t = readtree(tree_file, distances = mode == "phylogeny-restricted-bypd")
 
-    # WORKFLOW 1: bootstrap in random mode
-
-
-    if mode == "random":
-
-        
-        # Species list.
+    # Step 2: the blocks of cycles of this shard (all the cycles, with one single shard) and their names
 
-        species = t.species_list
-        allcycles = []
+    blocks = cycle_blocks(cycles, seed, shard_index, shard_count)
+    z.alltraits = ["b_" + str(i) for i in range(blocks[0][0] + 1, blocks[-1][0] + blocks[-1][1] + 1)] if len(blocks) > 0 else []
 
-        # Run the bootstrap
-        for i in range(1,cycles+1):
-            cycle_tag = "b_" + str(i)
+    # WORKFLOW 1: bootstrap in random mode
 
-            z.alltraits.append(cycle_tag)
 
-            resampled_fg = []
-            resampled_bg = []
+    if mode == "random":
 
-            while len(resampled_fg) < fg_len:
-                k = random.choice(species)
+        # Species list (sorted, so that the same seed always returns the same resampling)
 
-                if k not in resampled_fg:
-                    resampled_fg.append(k)
-        
-            while len(resampled_bg) < bg_len:
-                k = random.choice(species)
-                if k not in resampled_bg and k not in resampled_fg:
-                    resampled_bg.append(k)
-            
-            allcycles.append([resampled_fg, resampled_bg, cycle_tag])
-        
-        for c in allcycles:
+        species = sorted(t.species_list)
 
-            z.alltraits.append(c[2])
-            # Foreground
-            for s in c[0]:
-                z.update_dictionary(c[2], s, "1")
+        if fg_len + bg_len > len(species):
+            print("ERROR: foreground and background sizes (" + str(fg_len) + " + " + str(bg_len) + ") exceed the number of species in the tree (" + str(len(species)) + ")")
+            exit()
 
-            # Background
-            for s in c[1]:
-                z.update_dictionary(c[2], s, "0")
+        # Run the bootstrap: the cycles are drawn in chunks and written in bulk (text file and, optionally, binary file)
 
+        write_cycles(z, species, draw_random_cycles(len(species), fg_len, bg_len, blocks), simtraits_outfile, binary_outfile)
 
-        z.print_traits(simtraits_outfile)
         return z
     
     elif mode == "phylogeny-restricted-byfams":
 
         # Read from template
 
-        try:
+        template_fg, template_bg = read_template(template)
 
-            with open(template) as tcf_handle:
-                tcf = tcf_handle.read().splitlines()
-        
-            fg = []
-            bg = []
+        # Extract the groupfile (species -> group)
 
-            for l in tcf:
-                try:
-                    c = l.split("\t")
-                    if c[1] == "1":
-                        fg.append(c[0])
-                    elif c[1] == "0":
-                        bg.append(c[0])
-                except:
-                    pass
+        s2g = {}
+
+        try:
+            with open(groupfile) as gf_handle:
+                species_lines = gf_handle.read().splitlines()
         except:
-            print("ERROR: couldn't read template file. Input given:", template)
+            print("ERROR: couldn't read group file. Input given:", groupfile)
             exit()
 
-
-        # Extract the groupfile
-
-        with open(groupfile) as gf_handle:
-            species_lines = gf_handle.read().splitlines()
-
-        # Extract the species dictionaries
-
-        s2g = {}
-        g2s = {}
-
         for line in species_lines:
-            try:
-                c = line.split("\t")
+            c = line.split("\t")
+            if len(c) > 1:
                 s2g[c[0]] = c[1]
 
-                    # Update g2s
-                try:
-                    g2s[c[1]].append(c[0])
-                except:
-                    g2s[c[1]] = [c[0]]
-            except:
-                pass
-        
-        species = s2g.keys()
+        missing = [x for x in template_fg + template_bg if x not in s2g]
 
-        allcycles = []
+        if len(missing) > 0:
+            print("ERROR: template species not found in the group file:", ",".join(missing))
+            exit()
 
-        # Run the bootstrap
-        for i in range(1,cycles+1):
-            cycle_tag = "b_" + str(i)
+        # Each template species is replaced by a species of its group. Infeasible templates are rejected here.
 
-            z.alltraits.append(cycle_tag)
+        species = sorted(s2g.keys())
+        members, fg_counts, bg_counts = group_samples(species, s2g, template_fg, template_bg, "group")
 
-            resampled_fg = []
-            resampled_bg = []
+        # Run the bootstrap: the cycles are drawn in chunks and written in bulk
 
-            for x in fg:
-                flag = 0
-                while flag != 1:
-                    g = s2g[x]
-                    x = random.choice(g2s[g])
+        write_cycles(z, species, draw_group_cycles(members, fg_counts, bg_counts, blocks), simtraits_outfile, binary_outfile)
 
-                    if x not in resampled_fg:
-                        resampled_fg.append(x)
-                        flag = 1
+        return z
 
+    elif mode == "phylogeny-restricted-bypd":
 
-            for x in bg:
-                flag = 0
-                while flag != 1:
-                    g = s2g[x]
-                    x = random.choice(g2s[g])
+        # The template species are binned by their distance from the farthest species of the tree:
+        # every cycle replaces each of them with a species of the same bin.
 
-                    if x not in resampled_bg and x not in resampled_fg:
-                        resampled_bg.append(x)
-                        flag = 1
+        template_fg, template_bg = read_template(template)
 
+        missing = [x for x in template_fg + template_bg if x not in t.species_to_index]
 
-            resampled_bg.sort()
-            resampled_fg.sort()
-            
-            allcycles.append([resampled_fg, resampled_bg, cycle_tag])
+        if len(missing) > 0:
+            print("ERROR: template species not found in the tree:", ",".join(missing))
+            exit()
 
-        for c in allcycles:
+        species = sorted(t.species_list)
+        s2b = distance_bins(t, pd_bins)
 
-            z.alltraits.append(c[2])
-            # Foreground
-            for s in c[0]:
-                z.update_dictionary(c[2], s, "1")
+        members, fg_counts, bg_counts = group_samples(species, s2b, template_fg, template_bg, "distance bin")
 
-            # Background
-            for s in c[1]:
-                z.update_dictionary(c[2], s, "0")
+        # Run the bootstrap: the cycles are drawn in chunks and written in bulk
 
+        write_cycles(z, species, draw_group_cycles(members, fg_counts, bg_counts, blocks), simtraits_outfile, binary_outfile)
 
-        z.print_traits(simtraits_outfile)
         return z
 
-    elif mode == "phylogeny-restricted-byfams":
-        print("Sorry, this function is not implemented yet")
-        exit()
-
     elif mode == "bm":
 
         if tree_file == "none":
@@ -316,27 +575,41 @@ def simtrait(fg_len, bg_len, template, tree_file, mode, groupfile, phenotype_val
             print("See documentation.")
             exit()
         
-        script_path = os.path.realpath(sys.argv[0]).split("/")
-        script_path.remove(script_path[-1])
-        rscript_path = "/".join(script_path) + "/permulations.r"
+        if permulation_selection_strategy not in ("random", "inner", "edges"):
+            print("ERROR: unknown selection strategy", permulation_selection_strategy + ". Choose among random, inner and edges.")
+            exit()
 
-        os.system("ln -s " + rscript_path)
-        
-        r_line = " ".join([
-            
-            "./permulations.r",                     # Rscript
-            tree_file,                              # args[1]
-            template,                               # args[2]
-            str(cycles),                            # args[3]
-            permulation_selection_strategy,         # args[4]
-            phenotype_values_file,                  # args[5]
-            simtraits_outfile                          # args[6]
-        ])
-        os.system(r_line)
-
-# FUNCTION simtrait_revive() revive resampled trait from
+        # Template groups and phenotype values. The tree is pruned to the species with a phenotype value.
+
+        template_fg, template_bg = read_template(template)
+        values = read_trait_values(phenotype_values_file)
+
+        species = sorted([x for x in t.species_list if x in values])
+
+        fg_values = [values[x] for x in template_fg if x in values]
+        bg_values = [values[x] for x in template_bg if x in values]
+
+        if len(species) == 0:
+            print("ERROR: none of the species of the tree has a value in", phenotype_values_file)
+            exit()
+
+        # Run the permulations: the cycles are simulated in chunks and written in bulk
+
+        chunks = draw_bm_cycles(t, species, values, fg_len, bg_len, blocks,
+                    strategy = permulation_selection_strategy,
+                    fg_values = fg_values,
+                    bg_values = bg_values)
+
+        write_cycles(z, species, chunks, simtraits_outfile, binary_outfile)
+
+        return z
+
+# FUNCTION simtrait_revive() revive resampled trait from a tab cycles file or from a binary cycles file (memory-mapped)
 
 def simtrait_revive(traitfile):
+
+    if is_binary_cycles(traitfile):
+        return load_cycles(traitfile)
     
     # Class multicfg
 
@@ -366,8 +639,6 @@ def simtrait_revive(traitfile):
                     self.trait2bg[traitname].append(species)
                 except:
                     self.trait2bg[traitname] = [species]
-            
-            self.alltraits.append(traitname)
         
         
         def print_traits(self, outfile):
@@ -397,6 +668,8 @@ def simtrait_revive(traitfile):
             fg = c[1].split(",")
             bg = c[2].split(",")
 
+            z.alltraits.append(cycleid)
+
             # Foreground update
 
             for s in fg:
@@ -26,11 +26,24 @@ update_dictionary()         a function to update a dictionary with
                             new information. No, there is no built-in method for
                             this.
 
+multicfg                    The trait object (species to traits, traits to
+                            foreground and background species).
+
 load_cfg_dictionary()       Loads the multi cfg dictionary
 
+load_traits()               Loads one or many traits (a trait file, a directory
+                            of trait files or a comma-separated list of them).
+
+trait_index                 The compiled trait object: species interned to integer
+                            ids, fg/bg index arrays and masks per trait.
+
+compile_traits()            Builds the trait index of a trait object (once).
+
 '''
 
+import os
 import glob
+import numpy as np
 
 # FUNCTION update dictionary
 # A function to update a dictionary with new information. No, there is no built-in method for this.
@@ -41,69 +54,166 @@ def update_dictionary(dictionary, key, value):
     except:
         dictionary[key] = [value]
 
-# FUNCTION load multi cfg dictionary
-# Loads the multi cfg dictionary
+# CLASS multicfg
+# The trait object. Kept at module level so that it can be shipped to worker processes.
 
-def load_cfg(input_path, mode = "mono"):
+class multicfg():
 
-    class multicfg():
+    def __init__(self):
+        self.s2t = {}
+        self.alltraits = []
+        self.trait2fg = {}
+        self.trait2bg = {}
 
-        def __init__(self):
-            self.s2t = {}
-            self.alltraits = []
-            self.trait2fg = {}
-            self.trait2bg = {}
+    def update_dictionary(self, traitname, species, group):
+        try:
+            self.s2t[species].append(traitname + "_" + group)
+        except:
+            self.s2t[species] = [traitname + "_" + group]
+        
+        if group == "1":
+            try:
+                self.trait2fg[traitname].append(species)
+            except:
+                self.trait2fg[traitname] = [species]
 
-        def update_dictionary(self, traitname, species, group):
+        if group == "0":
             try:
-                self.s2t[species].append(traitname + "_" + group)
+                self.trait2bg[traitname].append(species)
             except:
-                self.s2t[species] = [traitname + "_" + group]
-            
-            if group == "1":
-                try:
-                    self.trait2fg[traitname].append(species)
-                except:
-                    self.trait2fg[traitname] = [species]
-
-            if group == "0":
-                try:
-                    self.trait2bg[traitname].append(species)
-                except:
-                    self.trait2bg[traitname] = [species]
+                self.trait2bg[traitname] = [species]
 
-    z = multicfg()
+# FUNCTION read_cfg()
+# Reads one trait file into the trait object, under the given trait name
+
+def read_cfg(z, traitname, input_path):
+
+    z.alltraits.append(traitname)
+
+    with open(input_path) as singlecfg_f:
+        singlecfg =  singlecfg_f.read().splitlines()
+
+    for line in singlecfg:
+        try:
+            c = line.split()
+            z.update_dictionary(traitname, c[0], c[1])
+        except:
+            pass
 
-    if mode == "multi":
 
-        for x in glob.glob(input_path + "/*"):
+# FUNCTION load multi cfg dictionary
+# Loads the multi cfg dictionary
+
+def load_cfg(input_path, mode = "mono"):
 
-            traitname = x.split("/")[-1]
-            z.alltraits.append(traitname)
+    z = multicfg()
+
+    if mode == "multi":
 
-            with open(x) as singlecfg_f:
-                singlecfg =  singlecfg_f.read().splitlines()
-            
-            for line in singlecfg:
-                try:
-                    c = line.split()
-                    z.update_dictionary(traitname, c[0], c[1])
-                except:
-                    pass
+        for x in sorted(glob.glob(input_path + "/*")):
+            read_cfg(z, x.split("/")[-1], x)
     
     elif mode == "mono":
+        read_cfg(z, input_path.split("/")[-1], input_path)
 
-        traitname = input_path.split("/")[-1]
-        z.alltraits.append(traitname)
+    return z
 
-        with open(input_path) as singlecfg_f:
-            singlecfg =  singlecfg_f.read().splitlines()
-            
-        for line in singlecfg:
-            try:
-                c = line.split()
-                z.update_dictionary(traitname, c[0], c[1])
-            except:
-                pass
 
-    return z
\ No newline at end of file
+# FUNCTION load_traits()
+# Loads one or many traits in one trait object: a trait file, a directory of trait files or a comma-separated
+# list of trait files. Each trait is named after its file. Raises a ValueError if two traits have the same name.
+
+def load_traits(input_string):
+
+    if os.path.isdir(input_string):
+        paths = [x for x in sorted(glob.glob(input_string.rstrip("/") + "/*")) if os.path.isfile(x)]
+    else:
+        paths = [x for x in input_string.split(",") if x != ""]
+
+    z = multicfg()
+
+    for x in paths:
+        traitname = x.rstrip("/").split("/")[-1]
+
+        if traitname in z.alltraits:
+            raise ValueError("two trait files named " + traitname)
+
+        read_cfg(z, traitname, x)
+
+    return z
+
+
+# CLASS trait_index
+# The compiled trait object. Species are interned to integer ids, each trait has its fg and bg
+# index arrays (in the order of the cfg, without duplicates) and its row in the fg/bg masks.
+
+class trait_index():
+
+    def __init__(self, multiconfig):
+
+        # Traits: the declared ones first, then those that only appear in the groups
+
+        self.traits = list(dict.fromkeys(list(multiconfig.alltraits) + list(multiconfig.trait2fg.keys()) + list(multiconfig.trait2bg.keys())))
+        self.trait_number = {x : i for i, x in enumerate(self.traits)}
+
+        # Species interning
+
+        self.species = []
+        self.species_id = {}
+
+        for trait in self.traits:
+            for species in multiconfig.trait2fg.get(trait, []) + multiconfig.trait2bg.get(trait, []):
+                if species not in self.species_id:
+                    self.species_id[species] = len(self.species)
+                    self.species.append(species)
+
+        self.species_set = frozenset(self.species)
+
+        # Per trait index arrays, species sets and masks (traits x species)
+
+        self.fg_ids = {}
+        self.bg_ids = {}
+        self.fg_set = {}
+        self.bg_set = {}
+
+        self.fg_mask = np.zeros((len(self.traits), len(self.species)), dtype = bool)
+        self.bg_mask = np.zeros((len(self.traits), len(self.species)), dtype = bool)
+
+        # Species to (trait, group) pairs
+
+        self.species_groups = {x : [] for x in self.species}
+
+        for i, trait in enumerate(self.traits):
+
+            fg = list(dict.fromkeys(multiconfig.trait2fg.get(trait, [])))
+            bg = list(dict.fromkeys(multiconfig.trait2bg.get(trait, [])))
+
+            self.fg_ids[trait] = np.array([self.species_id[x] for x in fg], dtype = np.int64)
+            self.bg_ids[trait] = np.array([self.species_id[x] for x in bg], dtype = np.int64)
+            self.fg_set[trait] = frozenset(fg)
+            self.bg_set[trait] = frozenset(bg)
+
+            self.fg_mask[i, self.fg_ids[trait]] = True
+            self.bg_mask[i, self.bg_ids[trait]] = True
+
+            for x in fg:
+                self.species_groups[x].append((trait, "1"))
+            for x in bg:
+                self.species_groups[x].append((trait, "0"))
+
+    # Alignment rows of the species (-1 if the species is not in the alignment)
+
+    def alignment_rows(self, species_index):
+        return np.array([species_index.get(x, -1) for x in self.species], dtype = np.int64)
+
+
+# FUNCTION compile_traits()
+# Builds the trait index of a trait object. The index is built once and kept in the trait object.
+
+def compile_traits(multiconfig):
+
+    try:
+        return multiconfig.index
+    except AttributeError:
+        multiconfig.index = trait_index(multiconfig)
+        return multiconfig.index
@@ -0,0 +1,337 @@
+#                      _              _
+#                     | |            | |
+#   ___ __ _  __ _ ___| |_ ___   ___ | |___
+#  / __/ _` |/ _` / __| __/ _ \ / _ \| / __|
+# | (_| (_| | (_| \__ \ || (_) | (_) | \__ \
+#  \___\__,_|\__,_|___/\__\___/ \___/|_|___/
+
+
+'''
+A Convergent Amino Acid Substitution identification
+and analysis toolbox
+
+Author:         Fabio Barteri (fabio.barteri@upf.edu)
+
+Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
+                Xavier Farré (xfarrer@igtp.cat),
+                David de Juan (david.juan@upf.edu).
+
+MODULE NAME:    profiler.py
+DESCRIPTION:    The run profile (--profile): wall time and calls per stage, counters (columns
+                kept and discarded by the filters, CAAS per pattern...), pvalue cache hits and
+                peak memory, written as a JSON report. The profile is off by default: then a
+                stage is a shared empty context, a counter returns at once and the profiled
+                functions are the functions themselves.
+DEPENDENCIES:   hyper
+CALLED BY:      ct, alimport, runslice, slicecache, disco, caas_id, hyper, boot, batch
+
+TABLE OF CONTENTS
+------------------------------------------
+enable_profile()            Turns the profile on (and resets it).
+
+reset_profile()             Clears the stages and the counters.
+
+start_run()                 Starts the profile of one run (e.g. one alignment of a
+                            batch), saving the profile in progress.
+
+end_run()                   The report of the run, and the saved profile back.
+
+stage()                     Context manager timing a stage.
+
+profiled()                  A function whose calls are timed as a stage (the function
+                            itself, when the profile is off).
+
+profiled_iterator()         An iterator whose items are timed as a stage (the iterator
+                            itself, when the profile is off).
+
+count()                     Adds to a counter.
+
+profile_report()            The report of the stages and the counters since the last
+                            reset.
+
+merge_reports()             Aggregates the reports of many runs (batch mode).
+
+write_report()              Writes the JSON report.
+'''
+
+import sys
+import json
+import time
+import contextlib
+
+try:
+    import resource
+except ImportError:                 # (not available on Windows: no peak memory in the report)
+    resource = None
+
+
+# The profile state (one per process: the batch workers send their reports to the parent process)
+
+enabled = False
+
+stages = {}                         # Stage name -> [seconds, calls]
+counters = {}                       # Counter name -> value
+started = None                      # Time of the last reset
+cache_start = None                  # pvalue cache info at the last reset
+
+no_stage = contextlib.nullcontext()
+
+
+# FUNCTION enable_profile()
+# Turns the profile on (and resets it)
+
+def enable_profile():
+
+    global enabled
+
+    enabled = True
+    reset_profile()
+
+
+# FUNCTION reset_profile()
+# Clears the stages and the counters
+
+def reset_profile():
+
+    global started, cache_start
+
+    stages.clear()
+    counters.clear()
+    started = time.perf_counter()
+    cache_start = cache_info()
+
+
+# FUNCTION start_run()
+# Starts the profile of one run (e.g. an alignment of a batch, in a worker or in the main process). Returns the profile
+# in progress, to be given back to end_run().
+
+def start_run():
+
+    global stages, counters, started, cache_start
+
+    saved = (stages, counters, started, cache_start)
+
+    stages = {}
+    counters = {}
+    started = time.perf_counter()
+    cache_start = cache_info()
+
+    return saved
+
+
+# FUNCTION end_run()
+# The report of the run, and the saved profile back. The pvalue cache lookups of the run are moved out of the saved
+# profile (same process, same caches), so that they are not counted twice when the reports are merged.
+
+def end_run(saved, label = None):
+
+    global stages, counters, started, cache_start
+
+    report = profile_report(label)
+
+    stages, counters, started, cache_start = saved
+
+    for name, c in report["pvalue_cache"].items():
+        cache_start[name] = dict(cache_start[name], hits = cache_start[name]["hits"] + c["hits"], misses = cache_start[name]["misses"] + c["misses"])
+
+    return report
+
+
+# CLASS timed_stage
+# Adds its wall time and one call to a stage. The stages can be nested: the time of a stage includes the time of the
+# stages run within it.
+
+class timed_stage():
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exception):
+        add_time(self.name, time.perf_counter() - self.start)
+
+
+def add_time(name, seconds, calls = 1):
+
+    if name not in stages:
+        stages[name] = [0.0, 0]
+
+    stages[name][0] += seconds
+    stages[name][1] += calls
+
+
+# FUNCTION stage()
+# Context manager timing a stage: with stage("name"): ...
+
+def stage(name):
+
+    if not enabled:
+        return no_stage
+
+    return timed_stage(name)
+
+
+# FUNCTION profiled()
+# The function, with its calls timed as a stage. When the profile is off, the function itself.
+
+def profiled(function, name):
+
+    if not enabled:
+        return function
+
+    def timed_function(*args, **kwargs):
+        start = time.perf_counter()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            add_time(name, time.perf_counter() - start)
+
+    return timed_function
+
+
+# FUNCTION profiled_iterator()
+# The iterator, with the production of its items timed as a stage (one call per item), e.g. a lazy engine whose items
+# are consumed by the output loop. When the profile is off, the iterator itself.
+
+def profiled_iterator(iterable, name):
+
+    if not enabled:
+        return iterable
+
+    return timed_iterator(iter(iterable), name)
+
+
+def timed_iterator(iterator, name):
+
+    while True:
+        start = time.perf_counter()
+
+        try:
+            item = next(iterator)
+        except StopIteration:
+            add_time(name, time.perf_counter() - start, calls = 0)
+            return
+
+        add_time(name, time.perf_counter() - start)
+
+        yield item
+
+
+# FUNCTION count()
+# Adds a value to a counter
+
+def count(name, value = 1):
+
+    if not enabled:
+        return
+
+    counters[name] = counters.get(name, 0) + int(value)
+
+
+# FUNCTION cache_info()
+# The hits and misses of the pvalue caches (hyper is imported here: it is profiled itself)
+
+def cache_info():
+
+    from modules.hyper import pvalue_cache_info
+
+    return pvalue_cache_info()
+
+
+# FUNCTION peak_rss()
+# Peak resident memory (MB) of this process and of its terminated child processes (e.g. a pool of workers)
+
+def peak_rss():
+
+    if resource == None:
+        return None, None
+
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    scale = 1048576.0 if sys.platform == "darwin" else 1024.0
+
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+
+    return round(own, 1), round(children, 1)
+
+
+# FUNCTION profile_report()
+# The report of the stages and the counters since the last reset, as a dictionary
+
+def profile_report(label = None):
+
+    cache_now = cache_info()
+    own, children = peak_rss()
+
+    report = {
+        "label" : label,
+        "wall_seconds" : round(time.perf_counter() - started, 6),
+        "stages" : {x : {"seconds" : round(y[0], 6), "calls" : y[1]} for x, y in sorted(stages.items())},
+        "counters" : dict(sorted(counters.items())),
+        "pvalue_cache" : {},
+        "peak_rss_mb" : own,
+        "peak_rss_children_mb" : children
+    }
+
+    # The pvalue cache hits and misses of this run (the caches live as long as the process)
+
+    for name in cache_now:
+        report["pvalue_cache"][name] = {
+            "hits" : cache_now[name]["hits"] - cache_start[name]["hits"],
+            "misses" : cache_now[name]["misses"] - cache_start[name]["misses"],
+            "size" : cache_now[name]["size"]
+        }
+
+    return report
+
+
+# FUNCTION merge_reports()
+# Aggregates the reports of many runs: the stage times, the calls, the counters and the pvalue cache hits and misses
+# are summed (the stage times of parallel runs can exceed the wall time), the wall time and the peak memory are the maximum.
+
+def merge_reports(reports, label = None):
+
+    merged = {"label" : label, "wall_seconds" : 0.0, "stages" : {}, "counters" : {}, "pvalue_cache" : {}, "peak_rss_mb" : None, "peak_rss_children_mb" : None}
+
+    for report in reports:
+
+        merged["wall_seconds"] = max(merged["wall_seconds"], report["wall_seconds"])
+
+        for name, s in report["stages"].items():
+            merged["stages"].setdefault(name, {"seconds" : 0.0, "calls" : 0})
+            merged["stages"][name]["seconds"] = round(merged["stages"][name]["seconds"] + s["seconds"], 6)
+            merged["stages"][name]["calls"] += s["calls"]
+
+        for name, value in report["counters"].items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + value
+
+        for name, c in report["pvalue_cache"].items():
+            merged["pvalue_cache"].setdefault(name, {"hits" : 0, "misses" : 0})
+            merged["pvalue_cache"][name]["hits"] += c["hits"]
+            merged["pvalue_cache"][name]["misses"] += c["misses"]
+
+        for key in ("peak_rss_mb", "peak_rss_children_mb"):
+            if report[key] != None:
+                merged[key] = max(merged[key] or 0, report[key])
+
+    merged["stages"] = dict(sorted(merged["stages"].items()))
+    merged["counters"] = dict(sorted(merged["counters"].items()))
+
+    return merged
+
+
+# FUNCTION write_report()
+# Writes the JSON report of a run: the totals and, in batch mode, the report of each alignment
+
+def write_report(output_file, tool, total, runs = None):
+
+    out = {"tool" : tool, "total" : total}
+
+    if runs != None:
+        out["runs"] = runs
+
+    with open(output_file, "w") as output_handle:
+        json.dump(out, output_handle, indent = 2)
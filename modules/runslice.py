@@ -18,36 +18,44 @@ Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
 
 MODULE NAME:    runslice.py
 DESCRIPTION:    The slicer function.
-DEPENDENCIES:   TBD
+DEPENDENCIES:   alimport, pindex, slicecache
+
+TABLE OF CONTENTS
+------------------------------------------
+column_chunk()              The number of columns processed at once.
+
+allowed_nulls()             The gaps and missing species allowed in fg and bg.
+
+trait_thresholds()          The minimum number of changes a column needs, per trait.
+
+column_threshold()          The minimum number of changes a column needs (any trait).
+
+trait_prefilter()           Keeps the columns that can be a CAAS for at least one
+                            trait (and tells for which ones).
+
+runslice()                  Slices an alignment.
 '''
 from modules.alimport import *
+from modules.pindex import compile_traits
+from modules.slicecache import cached_slice
+from modules import profiler
 
-### Function runslice (collects the )
-def runslice(options_object):
+import numpy as np
 
-    # Inputs (transferring parsed options_object to variables)
-    the_alignment = options_object.single_alignment
-    alignment_format = options_object.ali_format
 
-    # Alignment slice: 1- Calculate column treshold
+### Function column_chunk (the number of columns processed at once, --chunk_size)
+def column_chunk(options_object):
 
-    with open(options_object.config_file) as cfg_handle:
-        cfg_list = cfg_handle.read().splitlines()
-    
-    values = []
+    chunk_size = getattr(options_object, "chunk_size", "none")
 
-    for x in cfg_list:
-        try:
-            c = x.split("\t")
-            values.append(c[1])
-        except:
-            pass
-    
-    fg_species = values.count("1")
-    bg_species = values.count("0")
+    if chunk_size == "none":
+        return COLUMN_CHUNK
 
+    return int(chunk_size)
 
-    # Alignment slicing: sum the null values (allowed_gaps + allowed_missing_species)
+
+### Function allowed_nulls (the gaps plus the missing species allowed in the foreground and in the background)
+def allowed_nulls(options_object):
 
     sum_nulls_fg = 0
 
@@ -65,16 +73,180 @@ def runslice(options_object):
         except:
             pass
 
+    return sum_nulls_fg, sum_nulls_bg
+
+
+### Function trait_thresholds (the minimum number of changes a column needs to be a CAAS, per trait)
+def trait_thresholds(options_object, trait_object):
+
+    index = compile_traits(trait_object)
+    sum_nulls_fg, sum_nulls_bg = allowed_nulls(options_object)
 
+    return {x : min(len(index.fg_ids[x]) - sum_nulls_fg, len(index.bg_ids[x]) - sum_nulls_bg) for x in index.traits}
+
+### Function column_threshold (the minimum number of changes a column needs to be kept)
+def column_threshold(options_object, trait_object = None):
+
+    # Alignment slice: 1- Calculate column treshold. The fg and bg sizes come from the
+    # compiled trait index when the trait is already loaded, otherwise from the cfg file.
+
+    if trait_object != None:
+        return min(trait_thresholds(options_object, trait_object).values())
+
+    else:
+        with open(options_object.config_file) as cfg_handle:
+            cfg_list = cfg_handle.read().splitlines()
+        
+        values = []
+
+        for x in cfg_list:
+            try:
+                c = x.split("\t")
+                values.append(c[1])
+            except:
+                pass
+        
+        fg_species = values.count("1")
+        bg_species = values.count("0")
+
+
+    # Alignment slicing: sum the null values (allowed_gaps + allowed_missing_species)
+
+    sum_nulls_fg, sum_nulls_bg = allowed_nulls(options_object)
 
     fg_threshold = fg_species - sum_nulls_fg
     bg_threshold = bg_species - sum_nulls_bg
 
     c_threshold = min(fg_threshold, bg_threshold)
 
+    return c_threshold
+
+
+### Function trait_prefilter (keeps the columns that can be a CAAS for at least one trait)
+# A column can only be a CAAS for a trait if it has at least the changes of the trait threshold, both groups have
+# at least one amino acid within the gap limits and, within the species of the trait, the species without the most
+# frequent amino acid are at least as many as the smaller group. All the traits are tested on all the columns at once
+# (the counts per trait are products of the trait masks and the amino acid masks), in chunks of columns. The union of
+# the columns is kept and the columns of each trait are saved in the trait_columns of the sliced object.
+
+def trait_prefilter(sliced_object, options_object, trait_object, chunk_size = COLUMN_CHUNK):
+
+    index = compile_traits(trait_object)
+    thresholds = trait_thresholds(options_object, trait_object)
+
+    matrix = sliced_object.matrix
+    nspecies, ncolumns = matrix.shape
+    ntraits = len(index.traits)
+
+    # Trait masks over the alignment rows (traits x species) and missing species per trait
+
+    alignment_rows = index.alignment_rows(sliced_object.species_index)
+
+    fg = np.zeros((ntraits, nspecies), dtype = np.float32)
+    bg = np.zeros((ntraits, nspecies), dtype = np.float32)
+    mfg = np.zeros(ntraits, dtype = np.int64)
+    mbg = np.zeros(ntraits, dtype = np.int64)
+
+    for i, x in enumerate(index.traits):
+        rows = alignment_rows[index.fg_ids[x]]
+        fg[i, rows[rows >= 0]] = 1
+        mfg[i] = np.count_nonzero(rows < 0)
+
+        rows = alignment_rows[index.bg_ids[x]]
+        bg[i, rows[rows >= 0]] = 1
+        mbg[i] = np.count_nonzero(rows < 0)
+
+    group = np.maximum(fg, bg)
+    threshold = np.array([thresholds[x] for x in index.traits], dtype = np.float32)[:, np.newaxis]
+
+    possible = np.zeros((ntraits, ncolumns), dtype = bool)
+
+    for start in range(0, ncolumns, chunk_size):
+        chunk = matrix[:, start:start + chunk_size]
+
+        # Gaps and most frequent amino acid: over all the species and within the species of each trait
+
+        gaps = (chunk == GAP).astype(np.float32)
+
+        gfg = fg @ gaps
+        gbg = bg @ gaps
+        ufg = fg.sum(axis = 1)[:, np.newaxis] - gfg
+        ubg = bg.sum(axis = 1)[:, np.newaxis] - gbg
+        ugroup = group.sum(axis = 1)[:, np.newaxis] - group @ gaps
+
+        most_frequent = np.zeros(chunk.shape[1], dtype = np.float32)
+        most_frequent_group = np.zeros((ntraits, chunk.shape[1]), dtype = np.float32)
+
+        for symbol in np.flatnonzero(np.bincount(chunk.ravel(order = "F"), minlength = 256)):
+            if symbol != GAP:
+                present = (chunk == symbol).astype(np.float32)
+                np.maximum(most_frequent, present.sum(axis = 0), out = most_frequent)
+                np.maximum(most_frequent_group, group @ present, out = most_frequent_group)
+
+        seconds = nspecies - gaps.sum(axis = 0) - most_frequent
+        seconds_group = ugroup - most_frequent_group
+
+        # The columns that can be a CAAS, per trait
+
+        chunk_possible = (seconds[np.newaxis, :] >= threshold) & (ufg >= 1) & (ubg >= 1) & (seconds_group >= np.minimum(ufg, ubg))
+
+        if options_object.max_fg_gaps_string != "NO":
+            chunk_possible &= gfg <= int(options_object.max_fg_gaps_string)
+        if options_object.max_bg_gaps_string != "NO":
+            chunk_possible &= gbg <= int(options_object.max_bg_gaps_string)
+        if options_object.max_gaps_string != "NO":
+            chunk_possible &= gfg + gbg <= int(options_object.max_gaps_string)
+
+        possible[:, start:start + chunk.shape[1]] = chunk_possible
+
+    if options_object.max_fg_miss_string != "NO":
+        possible[mfg > int(options_object.max_fg_miss_string)] = False
+    if options_object.max_bg_miss_string != "NO":
+        possible[mbg > int(options_object.max_bg_miss_string)] = False
+    if options_object.max_miss_string != "NO":
+        possible[mfg + mbg > int(options_object.max_miss_string)] = False
+
+    # Keep the union
+
+    kept = possible.any(axis = 0)
+    profiler.count("columns_discarded_prefilter", ncolumns - np.count_nonzero(kept))
+
+    out = slice_object(sliced_object.genename, sliced_object.species, np.asfortranarray(matrix[:, kept]), sliced_object.positions[kept])
+    out.trait_columns = dict(zip(index.traits, possible[:, kept]))
+
+    return out
+
+
+### Function runslice (collects the )
+def runslice(options_object, c_threshold = None, trait_object = None, positions = None):
+
+    # Inputs (transferring parsed options_object to variables)
+    the_alignment = options_object.single_alignment
+    alignment_format = options_object.ali_format
+
+    # Alignment slice: 1- Calculate column treshold (unless the caller already did, e.g. in batch mode)
+
+    if c_threshold == None:
+        c_threshold = column_threshold(options_object, trait_object)
+
+    # Alignment slice: 2- Filter positions (slice alignment), through the slice cache if there is one.
+    # With positions (e.g. a targeted bootstrap), only those positions are kept.
+
+    cache_dir = getattr(options_object, "slice_cache", "none")
+
+    if cache_dir != "none":
+        out = cached_slice(cache_dir, the_alignment, alignment_format, c_threshold, float(options_object.max_gaps_pos_string))
+
+        if positions != None:
+            out = select_columns(out, positions)
+
+    else:
+        out = slice(the_alignment, alignment_format, c_threshold, float(options_object.max_gaps_pos_string), positions, column_chunk(options_object))
 
-    # Alignment slice: 2- Filter positions (slice alignment)
+    # Alignment slice: 3- With the traits (discovery), keep the columns that can be a CAAS for at least one of them
 
-    out = slice(the_alignment, alignment_format, c_threshold, float(options_object.max_gaps_pos_string))
+    if trait_object != None:
+        with profiler.stage("trait_prefilter"):
+            out = trait_prefilter(out, options_object, trait_object, column_chunk(options_object))
 
     return out
@@ -0,0 +1,170 @@
+#                      _              _     
+#                     | |            | |    
+#   ___ __ _  __ _ ___| |_ ___   ___ | |___ 
+#  / __/ _` |/ _` / __| __/ _ \ / _ \| / __|
+# | (_| (_| | (_| \__ \ || (_) | (_) | \__ \
+#  \___\__,_|\__,_|___/\__\___/ \___/|_|___/
+
+
+'''
+A Convergent Amino Acid Substitution identification 
+and analysis toolbox
+
+Author:         Fabio Barteri (fabio.barteri@upf.edu)
+
+Contributors:   Alejandro Valenzuela (alejandro.valenzuela@upf.edu)
+                Xavier Farré (xfarrer@igtp.cat),
+                David de Juan (david.juan@upf.edu).
+
+MODULE NAME:    slicecache.py
+DESCRIPTION:    On-disk cache of the sliced alignments. Each entry is an uncompressed .npz
+                file (species, kept columns matrix and positions) named after a hash of
+                the MSA content, the MSA format, the column threshold and the gap ratio.
+                Repeated runs on the same alignment skip parsing and column filtering.
+DEPENDENCIES:   alimport
+CALLED BY:      runslice.py, ct
+
+TABLE OF CONTENTS
+------------------------------------------
+file_hash()                 Content hash of a file.
+
+cache_key()                 The cache key of a slice (MSA content + slicing settings).
+
+cached_slice()              slice() through the cache: loads the entry if it exists,
+                            otherwise slices the alignment and saves the entry.
+
+cache_entries()             Lists the cache entries (oldest use first).
+
+clean_cache()               Cache cleanup: removes the entries over a size limit
+                            (least recently used first) or older than a number of days.
+'''
+
+from modules.alimport import slice, slice_object, alignment_genename
+from modules import profiler
+
+import os
+import time
+import hashlib
+import zipfile
+import tempfile
+import numpy as np
+
+
+CACHE_VERSION = "1"
+CACHE_SUFFIX = ".slice.npz"
+
+
+# FUNCTION file_hash()
+# Content hash of a file (read in blocks of 1 MB)
+
+def file_hash(input_file):
+
+    h = hashlib.sha1()
+
+    with open(input_file, "rb") as input_handle:
+        for block in iter(lambda: input_handle.read(1048576), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+# FUNCTION cache_key()
+# The cache key of a slice: the MSA content, the MSA format, the column threshold and the gap ratio
+
+def cache_key(alignment_file, alignment_format, column_threshold, max_gaps):
+
+    settings = "\t".join([CACHE_VERSION, file_hash(alignment_file), alignment_format, str(int(column_threshold)), repr(float(max_gaps))])
+
+    return hashlib.sha1(settings.encode()).hexdigest()
+
+
+# FUNCTION cached_slice()
+# slice() through the cache. Loads the entry if it exists (and marks it as used), otherwise slices the alignment
+# and saves the entry. The entry is written to a temporary file and then renamed, so that parallel runs sharing the
+# same cache never read a partial entry.
+
+def cached_slice(cache_dir, alignment_file, alignment_format, column_threshold, max_gaps = 0.5):
+
+    genename = alignment_genename(alignment_file)
+    entry = os.path.join(cache_dir, cache_key(alignment_file, alignment_format, column_threshold, max_gaps) + CACHE_SUFFIX)
+
+    try:
+        with np.load(entry) as cached:
+            z = slice_object(genename, cached["species"].tolist(), np.asfortranarray(cached["matrix"]), cached["positions"])
+
+        os.utime(entry)
+        profiler.count("slice_cache_hits")
+        return z
+
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        pass
+
+    profiler.count("slice_cache_misses")
+
+    z = slice(alignment_file, alignment_format, column_threshold, max_gaps)
+
+    os.makedirs(cache_dir, exist_ok = True)
+
+    temporary_handle, temporary_file = tempfile.mkstemp(dir = cache_dir, suffix = ".tmp")
+
+    with os.fdopen(temporary_handle, "wb") as entry_handle:
+        np.savez(entry_handle, species = np.array(z.species, dtype = str), matrix = z.matrix, positions = z.positions)
+
+    os.replace(temporary_file, entry)
+
+    return z
+
+
+# FUNCTION cache_entries()
+# Lists the cache entries as (path, size, last use) tuples, the oldest use first
+
+def cache_entries(cache_dir):
+
+    entries = []
+
+    if not os.path.isdir(cache_dir):
+        return entries
+
+    for x in os.scandir(cache_dir):
+        if x.is_file() and x.name.endswith(CACHE_SUFFIX):
+            info = x.stat()
+            entries.append((x.path, info.st_size, info.st_mtime))
+
+    entries.sort(key = lambda x : x[2])
+
+    return entries
+
+
+# FUNCTION clean_cache()
+# Cache cleanup. Removes the entries not used in the last max_age_days days, then the least recently used ones
+# until the cache fits in max_size_mb megabytes. Returns the number of removed entries and the freed bytes.
+
+def clean_cache(cache_dir, max_size_mb = None, max_age_days = None):
+
+    entries = cache_entries(cache_dir)
+    removed = []
+
+    if max_age_days != None:
+        oldest = time.time() - float(max_age_days) * 86400
+        removed = [x for x in entries if x[2] < oldest]
+        entries = [x for x in entries if x[2] >= oldest]
+
+    if max_size_mb != None:
+        total = sum([x[1] for x in entries])
+        limit = float(max_size_mb) * 1048576
+
+        while total > limit and len(entries) > 0:
+            x = entries.pop(0)
+            removed.append(x)
+            total -= x[1]
+
+    freed = 0
+
+    for x in removed:
+        try:
+            os.remove(x[0])
+            freed += x[1]
+        except OSError:
+            pass
+
+    return len(removed), freed